@@ -9,12 +9,25 @@ class canio:
         self.rx_queue = None
         self.tx_queue = None
 
+        # pool of received frames, or None to allocate a new message per frame
+        self.pool = None
+
+        # software opcode pre-filter, a 256 entry lookup table, or None to accept all frames
+        self.opcode_filter = None
+        self.num_filtered = 0
+
+        # the node's own CAN ID, whose frames pass the pre-filter so that a CAN ID clash is still seen, or 0
+        self.filter_canid = 0
+
     def begin(self) -> None:
         pass
 
     def send_message(self, msg: canmessage) -> int:
         pass
 
+    async def queue_message(self, msg: canmessage, wait_for_completion: bool = False) -> int:
+        return self.send_message(msg)
+
     async def get_next_message(self) -> canmessage.canmessage:
         pass
 
@@ -26,3 +39,25 @@ class canio:
 
     def reset(self) -> None:
         pass
+
+    def set_filters(self, opcodes=None, hardware: bool = True, canid: int = 0) -> bool:
+        # accept only frames whose opcode is in opcodes, or all frames if opcodes is None
+        # frames without data (enumeration), and frames from the CAN ID canid, are always accepted
+        # with hardware False, the CAN controller is left to accept every frame and only the software filter applies
+        # returns True if the filter is (at least partly) applied in hardware
+        if opcodes is None:
+            self.opcode_filter = None
+        else:
+            self.opcode_filter = bytearray(256)
+            for op in opcodes:
+                self.opcode_filter[op] = 1
+
+        self.filter_canid = canid
+        return False
+
+    def accepts(self, dlc: int, opcode: int, canid: int) -> bool:
+        if self.opcode_filter is None or dlc == 0 or self.opcode_filter[opcode] or canid == self.filter_canid:
+            return True
+
+        self.num_filtered += 1
+        return False
@@ -1,9 +1,12 @@
 # canmessage.py
 
+import re
+
 from micropython import const
 
 import cbus
 import cbusdefs
+import cbustime
 import logger
 
 # 2.1.2 Event checks
@@ -37,6 +40,7 @@ QUERY_ALL = const(10)
 QUERY_NONE = const(11)
 QUERY_NN = const(12)
 QUERY_DN = const(13)
+QUERY_EXPR = const(14)
 
 event_opcodes = (
     cbusdefs.OPC_ACON,
@@ -81,16 +85,209 @@ event_opcodes_lookup = (
     ((cbusdefs.OPC_ACOF3, cbusdefs.OPC_ACON3), (cbusdefs.OPC_ASOF3, cbusdefs.OPC_ASON3))
 )
 
+# opcode classification flags, one byte per opcode in opcode_classes
+OPC_CLASS_EVENT = const(0x01)
+OPC_CLASS_SHORT = const(0x02)
+OPC_CLASS_OFF = const(0x04)
+OPC_CLASS_LONG_MESSAGE = const(0x08)
+OPC_CLASS_EXTENSION = const(0x10)
+OPC_CLASS_EXTRA_BYTES_SHIFT = const(5)
+OPC_CLASS_EXTRA_BYTES_MASK = const(0x60)
+
+
+# the response opcodes do not follow the low bit of the on/off pairs, so the off opcodes are named
+event_off_opcodes = (
+    cbusdefs.OPC_ACOF,
+    cbusdefs.OPC_ASOF,
+    cbusdefs.OPC_ACOF1,
+    cbusdefs.OPC_ASOF1,
+    cbusdefs.OPC_ACOF2,
+    cbusdefs.OPC_ASOF2,
+    cbusdefs.OPC_ACOF3,
+    cbusdefs.OPC_ASOF3,
+    cbusdefs.OPC_AROF,
+    cbusdefs.OPC_ARSOF,
+    cbusdefs.OPC_AROF1,
+    cbusdefs.OPC_ARSOF1,
+    cbusdefs.OPC_AROF2,
+    cbusdefs.OPC_ARSOF2,
+    cbusdefs.OPC_AROF3,
+    cbusdefs.OPC_ARSOF3
+)
+
+
+def build_opcode_classes() -> bytearray:
+    # one lookup per frame instead of a scan of event_opcodes
+    classes = bytearray(256)
+
+    for op in event_opcodes:
+        c = OPC_CLASS_EVENT
+
+        if op & (1 << 3):
+            c |= OPC_CLASS_SHORT
+        if op in event_off_opcodes:
+            c |= OPC_CLASS_OFF
+
+        # the top 3 bits are the data byte count, of which nn and en take 4
+        c |= ((op >> 5) - 4) << OPC_CLASS_EXTRA_BYTES_SHIFT
+
+        classes[op] = c
+
+    classes[cbusdefs.OPC_DTXC] |= OPC_CLASS_LONG_MESSAGE
+
+    # xxx11111, except 0x1f
+    for op in range(0x3f, 0x100, 0x20):
+        classes[op] |= OPC_CLASS_EXTENSION
+
+    return classes
+
+
+opcode_classes = build_opcode_classes()
+
+# receive scheduling classes, see circularQueue.priorityQueue
+RX_CLASS_URGENT = const(0)
+RX_CLASS_CONFIG = const(1)
+RX_CLASS_EVENT = const(2)
+RX_CLASS_BULK = const(3)
+
+RX_CLASS_WEIGHTS = (1, 4, 8, 2)
+
+urgent_opcodes = (cbusdefs.OPC_HLT, cbusdefs.OPC_BON, cbusdefs.OPC_ESTOP, cbusdefs.OPC_ARST, cbusdefs.OPC_RESTP)
+
+config_opcodes = (cbusdefs.OPC_ACK, cbusdefs.OPC_NAK, cbusdefs.OPC_RSTAT, cbusdefs.OPC_QNN, cbusdefs.OPC_RQNP,
+                  cbusdefs.OPC_RQMN, cbusdefs.OPC_SNN, cbusdefs.OPC_NNRSM, cbusdefs.OPC_RQNN, cbusdefs.OPC_NNACK,
+                  cbusdefs.OPC_NNLRN, cbusdefs.OPC_NNULN, cbusdefs.OPC_NNCLR, cbusdefs.OPC_NNEVN, cbusdefs.OPC_NERD,
+                  cbusdefs.OPC_RQEVN, cbusdefs.OPC_WRACK, cbusdefs.OPC_ENUM, cbusdefs.OPC_NNRST, cbusdefs.OPC_CMDERR,
+                  cbusdefs.OPC_EVNLF, cbusdefs.OPC_NVRD, cbusdefs.OPC_NENRD, cbusdefs.OPC_RQNPN, cbusdefs.OPC_NUMEV,
+                  cbusdefs.OPC_CANID, cbusdefs.OPC_EVULN, cbusdefs.OPC_NVSET, cbusdefs.OPC_NVANS, cbusdefs.OPC_PARAN,
+                  cbusdefs.OPC_REVAL, cbusdefs.OPC_REQEV, cbusdefs.OPC_NEVAL, cbusdefs.OPC_PNN, cbusdefs.OPC_EVLRN,
+                  cbusdefs.OPC_EVANS, cbusdefs.OPC_NAME, cbusdefs.OPC_PARAMS, cbusdefs.OPC_ENRSP, cbusdefs.OPC_EVLRNI)
+
+
+def build_rx_classes() -> bytearray:
+    # events, module configuration and emergency opcodes, and the rest (DCC, long messages, fast clock) as bulk
+    classes = bytearray(RX_CLASS_BULK for _ in range(256))
+
+    for op in event_opcodes:
+        classes[op] = RX_CLASS_EVENT
+    for op in config_opcodes:
+        classes[op] = RX_CLASS_CONFIG
+    for op in urgent_opcodes:
+        classes[op] = RX_CLASS_URGENT
+
+    return classes
+
+
+rx_classes = build_rx_classes()
+
+
+def receive_class(msg) -> int:
+    # frames sent at the highest major priority, and the RTR and zero-length frames of CAN ID enumeration,
+    # are urgent whatever their opcode
+    # a module's own messages, consumed with a CAN ID of 0, are classed by opcode
+    if msg.ext:
+        return RX_CLASS_BULK
+    if msg.rtr or msg.dlc == 0 or (msg.canid & 0x600 == 0 and msg.canid & 0x7f):
+        return RX_CLASS_URGENT
+    return rx_classes[msg.data[0]]
+
+# an event as one int: nn, en and polarity in the low bit, so keys stay small ints for node numbers below 0x2000
+NO_EVENT_KEY = const(-1)
+EVENT_KEY_SHORT_MASK = const(0x1ffff)
+
+
+def event_key(polarity: int, nn: int, en: int) -> int:
+    return (nn << 17) | (en << 1) | polarity
+
+
+def event_key_from_tuple(t: tuple) -> int:
+    return (t[1] << 17) | (t[2] << 1) | t[0]
+
+
+def event_keys(events: tuple) -> set:
+    # a single (polarity, nn, en) tuple or a tuple of them
+    if len(events) > 0 and not isinstance(events[0], tuple):
+        events = (events,)
+    # POLARITY_EITHER gives the keys of both polarities
+    keys = set()
+    for t in events:
+        if t[0] == POLARITY_EITHER:
+            keys.add(event_key(POLARITY_OFF, t[1], t[2]))
+            keys.add(event_key(POLARITY_ON, t[1], t[2]))
+        else:
+            keys.add(event_key_from_tuple(t))
+    return keys
+
+
+def compile_query(query_type: int, query=None):
+    # the form of a query passed to matches() for each frame
+    # event tuples become a set of event keys and regex strings are compiled, other queries are used as given
+    # QUERY_EXPR queries from cbusquery are compiled as they are built
+    if query_type in (QUERY_TUPLES, QUERY_TUPLE) and isinstance(query, tuple) and len(query) > 0:
+        events = query if isinstance(query[0], tuple) else (query,)
+        for t in events:
+            if len(t) != 3:
+                return query
+        return event_keys(events)
+
+    if query_type == QUERY_REGEX and isinstance(query, str):
+        return re.compile(query)
+
+    return query
+
+
+def opcodes_for_query(query_type: int, query=None) -> tuple | None:
+    # the opcodes a query can match, or None if it may match any frame
+    if query_type in (QUERY_OPCODES, QUERY_EVENTS):
+        return tuple(query)
+    elif query_type in (QUERY_TUPLES, QUERY_TUPLE):
+        if isinstance(query, set):
+            return event_opcodes if len(query) > 0 else ()
+        if not isinstance(query, tuple) or len(query) == 0:
+            return ()
+        opcodes = []
+        for t in (query if isinstance(query[0], tuple) else (query,)):
+            if len(t) == 3:
+                opcodes.extend(event_opcodes)
+            elif len(t) > 0:
+                opcodes.append(t[0])
+        return tuple(opcodes)
+    elif query_type == QUERY_ALL_EVENTS:
+        return event_opcodes
+    elif query_type == QUERY_LONG_MESSAGES:
+        return (cbusdefs.OPC_DTXC,)
+    elif query_type == QUERY_NONE:
+        return ()
+    elif query_type == QUERY_EXPR:
+        return query.opcodes()
+    else:
+        return None
+
 
 class canmessage:
+    # a small, fixed set of attributes, with the logger shared by the class rather than held per instance
+    # MicroPython keeps instance attributes in a dict, so received frames are reused from a messagepool
+    # rather than made smaller
+
+    logger = logger.logger()
+
     def __init__(self, canid: int = 0, dlc: int = 0, data=bytearray(8), rtr: bool = False, ext: bool = False):
-        self.logger = logger.logger()
-        self.canid = canid
-        self.make_header()
+        self.canid = (0x0b << 7) + (canid & 0x7f)
         self.dlc = dlc
         self.data = bytearray(data)
         self.rtr = rtr
         self.ext = ext
+        self.polarity = POLARITY_UNKNOWN
+
+        # the messagepool a received frame belongs to, set only on pooled frames, and its number of holders
+        self.pool = None
+        self.refs = 0
+
+        # tuple form of the message, computed on first use
+        self._tuple = None
+
+        # ticks_us() when created, or when a received frame was read from the controller
+        self.timestamp = cbustime.now_us()
 
     def __str__(self):
         rtr = "R" if self.rtr else ""
@@ -106,14 +303,47 @@ class canmessage:
         return cstr
 
     def __iter__(self):
-        if self.dlc > 0:
-            if self.is_event():
-                self.polarity = 0 if self.data[0] & 1 else 1
-                for x in self.polarity, self.get_node_number(), self.get_event_number():
-                    yield x
+        return iter(self.as_tuple())
+
+    def as_tuple(self) -> tuple:
+        # (polarity, nn, en) for an event, otherwise the data bytes
+        # the result is cached, so code that changes the data in place afterwards must call invalidate()
+        if self._tuple is None:
+            c = opcode_classes[self.data[0]] if self.dlc > 0 else 0
+            if c & OPC_CLASS_EVENT:
+                self.polarity = POLARITY_OFF if c & OPC_CLASS_OFF else POLARITY_ON
+                self._tuple = (self.polarity, (self.data[1] << 8) + self.data[2], (self.data[3] << 8) + self.data[4])
             else:
-                for x in self.data[:self.dlc]:
-                    yield x
+                self._tuple = tuple(self.data[:self.dlc])
+
+        return self._tuple
+
+    def invalidate(self) -> None:
+        self._tuple = None
+
+    def copy(self) -> canmessage:
+        msg = canmessage(dlc=self.dlc, data=self.data, rtr=self.rtr, ext=self.ext)
+        msg.canid = self.canid
+        msg.timestamp = self.timestamp
+        return msg
+
+    def retain(self) -> canmessage:
+        # hold a pooled frame beyond the current dispatch, to be given back with release()
+        if self.pool is not None:
+            self.pool.retain(self)
+        return self
+
+    def release(self) -> None:
+        # give up a hold on a pooled frame, which returns to its pool when the last holder releases it
+        # no effect on other messages
+        if self.pool is not None:
+            self.pool.release(self)
+
+    def freeze(self) -> None:
+        # the frame is about to be shared and must not change from here on
+        # checked when it is retained or released, in pool debug mode only, otherwise nothing stops a change
+        if self.pool is not None and self.pool.debug:
+            self.pool.freeze(self)
 
     def make_header(self, priority=0x0b) -> None:
         self.canid = (priority << 7) + (self.canid & 0x7f)
@@ -122,10 +352,29 @@ class canmessage:
         return self.canid & 0x7f
 
     def is_event(self) -> bool:
-        return self.data[0] in event_opcodes
+        return opcode_classes[self.data[0]] & OPC_CLASS_EVENT != 0
 
     def is_short_event(self) -> bool:
-        return True if self.is_event() and self.data[0] & (1 << 3) else False
+        return opcode_classes[self.data[0]] & (OPC_CLASS_EVENT | OPC_CLASS_SHORT) == OPC_CLASS_EVENT | OPC_CLASS_SHORT
+
+    def event_key(self) -> int:
+        # NO_EVENT_KEY if the message is not an event
+        c = opcode_classes[self.data[0]] if self.dlc > 0 else 0
+
+        if not c & OPC_CLASS_EVENT:
+            return NO_EVENT_KEY
+
+        d = self.data
+        return (d[1] << 25) | (d[2] << 17) | (d[3] << 9) | (d[4] << 1) | (POLARITY_OFF if c & OPC_CLASS_OFF else POLARITY_ON)
+
+    def is_long_message(self) -> bool:
+        return opcode_classes[self.data[0]] & OPC_CLASS_LONG_MESSAGE != 0
+
+    def is_extension(self) -> bool:
+        return opcode_classes[self.data[0]] & OPC_CLASS_EXTENSION != 0
+
+    def event_extra_bytes(self) -> int:
+        return (opcode_classes[self.data[0]] & OPC_CLASS_EXTRA_BYTES_MASK) >> OPC_CLASS_EXTRA_BYTES_SHIFT
 
     def get_node_number(self) -> int:
         return (self.data[1] << 8) + (self.data[2] & 0xff)
@@ -136,6 +385,17 @@ class canmessage:
     def get_node_and_event_numbers(self) -> tuple:
         return self.get_node_number(), self.get_event_number(),
 
+    def gridconnect(self) -> str:
+        # e.g. :SB020N9000010002;
+        tid = self.canid << 5
+        gc = f':X{tid:04X}' if self.ext else f':S{tid:04X}'
+        gc += 'R' if self.rtr else 'N'
+
+        for i in range(self.dlc):
+            gc += f'{self.data[i]:02X}'
+
+        return gc + ';'
+
     def print(self, hex_fmt=True) -> None:
         rtr = "R" if self.rtr else ""
         ext = "X" if self.ext else ""
@@ -165,18 +425,25 @@ class canmessage:
 
     def matches(self, query_type: int = QUERY_ALL, query=None) -> bool:
         if query_type in (QUERY_TUPLES, QUERY_TUPLE):
-            if isinstance(query, tuple):
+            if isinstance(query, set):
+                return self.event_key() in query
+            elif isinstance(query, tuple):
                 if isinstance(query[0], tuple):
-                    return tuple(self) in query
+                    return self.as_tuple() in query
                 else:
-                    return tuple(self) == query
+                    return self.as_tuple() == query
             else:
                 self.logger.log(f'matches: expected tuple as query, query = {query}')
                 return False
         elif query_type == QUERY_OPCODES:
             return self.data[0] in query
+        elif query_type == QUERY_EXPR:
+            return query.matches(self)
         elif query_type == QUERY_REGEX:
-            return True
+            # against the GridConnect form, slow as it builds a string for each frame
+            if isinstance(query, str):
+                query = re.compile(query)
+            return query.match(self.gridconnect()) is not None
         elif query_type == QUERY_CANID:
             return self.get_canid() == query
         elif query_type == QUERY_RTR:
@@ -188,7 +455,7 @@ class canmessage:
         elif query_type == QUERY_ALL_EVENTS:
             return self.is_event()
         elif query_type == QUERY_LONG_MESSAGES:
-            return self.data[0] == cbusdefs.OPC_DTXC
+            return self.is_long_message()
         elif query_type == QUERY_UDF:
             return query(self)
         elif query_type == QUERY_ALL:
@@ -201,6 +468,104 @@ class canmessage:
             return False
 
 
+class messagepool:
+    # a fixed set of preallocated frames for the receive path, to avoid allocating a message per frame
+    #
+    # ownership rules:
+    # - the CAN driver takes a frame with get() and passes it to cbus through the receive queue
+    # - cbus.process freezes the frame, and every consumer sees the same object, none may change it
+    # - freezing is not enforced outside debug mode: the data is an ordinary bytearray, and a consumer that
+    #   changes it changes the frame for every other consumer, so any change must be made to a copy()
+    # - handlers may only use the frame during the call
+    # - a consumer that keeps the frame after dispatch (subscription queues, the gridconnect server) holds
+    #   it with retain() and gives it back with release()
+    # - a frame taken from a subscription is held by the subscription until its next wait() or unsubscribe(),
+    #   so anything that keeps it longer must keep a copy()
+    # - cbus.process releases its own hold when dispatch is complete, and the frame returns to the pool
+    #   when the last holder has released it
+    # - if the pool is empty, get() returns an ordinary message, which is counted as a miss
+    #
+    # in debug mode, a released frame has its data buffer removed, so any read or write of its data
+    # raises an exception, replacing the buffer or releasing the frame twice is reported as well, and a frozen
+    # frame that has changed is reported when it is next retained or released
+
+    def __init__(self, size: int = 16, debug: bool = False):
+        self.size = size
+        self.debug = debug
+        self.free = []
+        self.buffers = {}
+        self.snapshots = {}
+        self.in_use = 0
+        self.hwm = 0
+        self.misses = 0
+
+        for _ in range(size):
+            msg = canmessage()
+            msg.pool = self
+            self.free.append(msg)
+
+            if self.debug:
+                self.buffers[id(msg)] = msg.data
+                msg.data = None
+
+    def get(self) -> canmessage:
+        if not self.free:
+            self.misses += 1
+            return canmessage()
+
+        msg = self.free.pop()
+
+        if self.debug:
+            if msg.data is not None:
+                raise RuntimeError('messagepool: frame data was replaced after release')
+            msg.data = self.buffers[id(msg)]
+
+        msg.refs = 1
+        self.in_use += 1
+        self.hwm = self.in_use if self.in_use > self.hwm else self.hwm
+        return msg
+
+    def retain(self, msg: canmessage) -> None:
+        if self.debug:
+            if msg.refs < 1:
+                raise RuntimeError('messagepool: frame retained after release')
+            self.check(msg)
+
+        msg.refs += 1
+
+    def release(self, msg: canmessage) -> None:
+        if msg.refs < 1:
+            if self.debug:
+                raise RuntimeError('messagepool: frame released twice')
+            return
+
+        if self.debug:
+            if msg.data is not self.buffers[id(msg)]:
+                raise RuntimeError('messagepool: frame data was replaced while in use')
+            self.check(msg)
+
+        msg.refs -= 1
+
+        if msg.refs > 0:
+            return
+
+        if self.debug:
+            self.snapshots.pop(id(msg), None)
+            msg.data = None
+
+        self.free.append(msg)
+        self.in_use -= 1
+
+    def freeze(self, msg: canmessage) -> None:
+        self.snapshots[id(msg)] = (msg.canid, msg.dlc, msg.rtr, msg.ext, bytes(msg.data))
+
+    def check(self, msg: canmessage) -> None:
+        snapshot = self.snapshots.get(id(msg))
+
+        if snapshot is not None and snapshot != (msg.canid, msg.dlc, msg.rtr, msg.ext, bytes(msg.data)):
+            raise RuntimeError('messagepool: frame was changed after it was published')
+
+
 class cbusevent(canmessage):
     def __init__(self, cbus: cbus.cbus, polarity: int = POLARITY_OFF, nn: int = 0, en: int = 0, send_now: bool = False):
         super().__init__(dlc=5)
@@ -248,6 +613,7 @@ class cbusevent(canmessage):
             self.nn = self.cbus.config.node_number
 
         self.data = bytearray([opcode, self.nn >> 8, self.nn & 0xff, self.en >> 8, self.en & 0xff])
+        self.invalidate()
 
 def message_from_tuple(t: tuple) -> canmessage:
     msg = canmessage()
@@ -278,7 +644,7 @@ def event_from_message(cbus: cbus.cbus, msg: canmessage) -> cbusevent:
     if msg.data[0] == -1:
         evt.polarity = -1
     else:
-        if msg.data[0] & 1:
+        if opcode_classes[msg.data[0]] & OPC_CLASS_OFF:
             evt.polarity = POLARITY_OFF
         else:
             evt.polarity = POLARITY_ON
@@ -23,6 +23,13 @@ MODE_CHANGING = const(2)
 MSGS_EVENTS_ONLY = const(0)
 MSGS_ALL = const(1)
 
+HANDLER_NONE = const(0)
+HANDLER_SYNC = const(1)
+HANDLER_ASYNC = const(2)
+
+# event indexes are one byte in CBUS, so events stored beyond this cannot be read or addressed by index
+MAX_EVENT_INDEX = const(255)
+
 
 class cbus:
     def __init__(
@@ -72,6 +79,10 @@ class cbus:
 
         self.histories = []
         self.subscriptions = []
+        self.router = cbuspubsub.router()
+
+        self.hardware_filtering = False
+        self.running = False
 
         self.gridconnect_server = None
 
@@ -87,47 +98,51 @@ class cbus:
         self.num_messages_received = 0
         self.num_messages_sent = 0
 
+        # a multi-frame reply, such as a NERD event table dump, runs as a task of its own
+        self.bulk_reply_task = None
+
         self.callback_flag = asyncio.ThreadSafeFlag()
         self.timer = machine.Timer(-1)
 
-        self.func_dict = {
-            cbusdefs.OPC_ACON: self.handle_accessory_event,
-            cbusdefs.OPC_ACOF: self.handle_accessory_event,
-            cbusdefs.OPC_ASON: self.handle_accessory_event,
-            cbusdefs.OPC_ASOF: self.handle_accessory_event,
-            cbusdefs.OPC_ACON1: self.handle_accessory_event,
-            cbusdefs.OPC_ACOF1: self.handle_accessory_event,
-            cbusdefs.OPC_ASON1: self.handle_accessory_event,
-            cbusdefs.OPC_ASOF1: self.handle_accessory_event,
-            cbusdefs.OPC_ACON2: self.handle_accessory_event,
-            cbusdefs.OPC_ACOF2: self.handle_accessory_event,
-            cbusdefs.OPC_ASON2: self.handle_accessory_event,
-            cbusdefs.OPC_ASOF2: self.handle_accessory_event,
-            cbusdefs.OPC_ACON3: self.handle_accessory_event,
-            cbusdefs.OPC_ACOF3: self.handle_accessory_event,
-            cbusdefs.OPC_ASON3: self.handle_accessory_event,
-            cbusdefs.OPC_ASOF3: self.handle_accessory_event,
-            cbusdefs.OPC_RQNP: self.handle_rqnp,
-            cbusdefs.OPC_RQNPN: self.handle_rqnpn,
-            cbusdefs.OPC_SNN: self.handle_snn,
-            cbusdefs.OPC_CANID: self.handle_canid,
-            cbusdefs.OPC_ENUM: self.handle_enum,
-            cbusdefs.OPC_NVRD: self.handle_nvrd,
-            cbusdefs.OPC_NVSET: self.handle_nvset,
-            cbusdefs.OPC_NNLRN: self.handle_nnlrn,
-            cbusdefs.OPC_NNULN: self.handle_nnuln,
-            cbusdefs.OPC_RQEVN: self.handle_rqevn,
-            cbusdefs.OPC_NERD: self.handle_nerd,
-            cbusdefs.OPC_REVAL: self.handle_reval,
-            cbusdefs.OPC_NNCLR: self.handle_nnclr,
-            cbusdefs.OPC_NNEVN: self.handle_nnevn,
-            cbusdefs.OPC_QNN: self.handle_qnn,
-            cbusdefs.OPC_RQMN: self.handle_rqmn,
-            cbusdefs.OPC_EVLRN: self.handle_evlrn,
-            cbusdefs.OPC_EVULN: self.handle_evuln,
-            cbusdefs.OPC_DTXC: self.handle_dtxc,
-            cbusdefs.OPC_RSTAT: self.handle_rstat,
-        }
+        # opcode dispatch, one slot per opcode
+        self.handlers = [None] * 256
+        self.handler_kinds = bytearray(256)
+        self.opcode_counts = [0] * 256
+
+        # held once, so that required_opcodes can tell the built-in event handler from one set by the application
+        self.accessory_event_handler = self.handle_accessory_event
+
+        for opcode in (
+            cbusdefs.OPC_ACON, cbusdefs.OPC_ACOF, cbusdefs.OPC_ASON, cbusdefs.OPC_ASOF,
+            cbusdefs.OPC_ACON1, cbusdefs.OPC_ACOF1, cbusdefs.OPC_ASON1, cbusdefs.OPC_ASOF1,
+            cbusdefs.OPC_ACON2, cbusdefs.OPC_ACOF2, cbusdefs.OPC_ASON2, cbusdefs.OPC_ASOF2,
+            cbusdefs.OPC_ACON3, cbusdefs.OPC_ACOF3, cbusdefs.OPC_ASON3, cbusdefs.OPC_ASOF3,
+        ):
+            self.set_opcode_handler(opcode, self.accessory_event_handler, HANDLER_SYNC)
+
+        for opcode, handler in (
+            (cbusdefs.OPC_RQNP, self.handle_rqnp),
+            (cbusdefs.OPC_RQNPN, self.handle_rqnpn),
+            (cbusdefs.OPC_SNN, self.handle_snn),
+            (cbusdefs.OPC_CANID, self.handle_canid),
+            (cbusdefs.OPC_ENUM, self.handle_enum),
+            (cbusdefs.OPC_NVRD, self.handle_nvrd),
+            (cbusdefs.OPC_NVSET, self.handle_nvset),
+            (cbusdefs.OPC_NNLRN, self.handle_nnlrn),
+            (cbusdefs.OPC_NNULN, self.handle_nnuln),
+            (cbusdefs.OPC_RQEVN, self.handle_rqevn),
+            (cbusdefs.OPC_NERD, self.handle_nerd),
+            (cbusdefs.OPC_REVAL, self.handle_reval),
+            (cbusdefs.OPC_NNCLR, self.handle_nnclr),
+            (cbusdefs.OPC_NNEVN, self.handle_nnevn),
+            (cbusdefs.OPC_QNN, self.handle_qnn),
+            (cbusdefs.OPC_RQMN, self.handle_rqmn),
+            (cbusdefs.OPC_EVLRN, self.handle_evlrn),
+            (cbusdefs.OPC_EVULN, self.handle_evuln),
+            (cbusdefs.OPC_DTXC, self.handle_dtxc),
+            (cbusdefs.OPC_RSTAT, self.handle_rstat),
+        ):
+            self.set_opcode_handler(opcode, handler)
 
     def begin(self, max_msgs: int = 10) -> None:
         self.config.begin()
@@ -135,6 +150,8 @@ class cbus:
         self.can.message_received_flag = self.callback_flag
         self.switch.switch_changed_state_flag = self.callback_flag
         self.can.begin()
+        self.running = True
+        self.update_filters()
 
         asyncio.create_task(self.process(max_msgs))
 
@@ -161,24 +178,96 @@ class cbus:
 
     def set_event_handler(self, event_handler) -> None:
         self.event_handler = event_handler
+        self.update_filters()
 
     def set_received_message_handler(self, received_message_handler, opcodes: tuple = ()) -> None:
         self.received_message_handler = received_message_handler
         self.opcodes = opcodes
+        self.update_filters()
+
+    def set_opcode_handler(self, opcode: int, handler, kind: int = HANDLER_ASYNC) -> None:
+        # handler(msg) is called for each received frame with this opcode, and awaited if kind is HANDLER_ASYNC
+        # this replaces any existing handler, including the module's own
+        self.handlers[opcode] = handler
+        self.handler_kinds[opcode] = kind if handler is not None else HANDLER_NONE
+        self.update_filters()
+
+    def remove_opcode_handler(self, opcode: int) -> None:
+        self.set_opcode_handler(opcode, None)
+
+    def set_hardware_filtering(self, state: bool = True) -> None:
+        # only receive the frames this module has a use for
+        # the filter is only applied in the CAN controller while hardware_filter_allowed() is True, that is in SLiM,
+        # otherwise, as on a FLiM node, frames are filtered in software only, before they are queued
+        # frames from this node's CAN ID always pass the software filter, so a CAN ID clash is still detected
+        self.hardware_filtering = state
+        self.update_filters()
+
+    def hardware_filter_allowed(self) -> bool:
+        # SLiM only: an opcode filter in the CAN controller cannot be relied on to pass RTR and zero-length frames,
+        # which a node with a node number must see to answer CAN ID enumeration and to enumerate itself,
+        # and it cannot pass frames by CAN ID alone, which FLiM CAN ID clash detection needs
+        # the acceptance filters match the identifier and the first data bytes only, so no filter or
+        # receive buffer can be set aside to admit these frames
+        return self.config.node_number == 0
+
+    def required_opcodes(self) -> tuple | None:
+        # the opcodes this module consumes, derived from the opcode handlers, the event table,
+        # and the message handlers, histories and subscriptions, or None if any frame may be required
+
+        if self.gridconnect_server:
+            return None
+
+        if self.received_message_handler is not None:
+            if not self.opcodes:
+                return None
+            opcodes = set(self.opcodes)
+        else:
+            opcodes = set()
+
+        # the built-in event handler only needs events while the event table holds any, other handlers always do
+        for op, kind in enumerate(self.handler_kinds):
+            if kind != HANDLER_NONE and self.handlers[op] is not self.accessory_event_handler:
+                opcodes.add(op)
+
+        if self.event_handler is not None and self.config.count_events() > 0:
+            opcodes.update(canmessage.event_opcodes)
+
+        for obj in self.histories + self.subscriptions:
+            ops = canmessage.opcodes_for_query(obj.query_type, obj.query)
+            if ops is None:
+                return None
+            opcodes.update(ops)
+
+        return tuple(opcodes)
+
+    def update_filters(self) -> None:
+        if not self.running:
+            return
+
+        if self.hardware_filtering:
+            self.can.set_filters(self.required_opcodes(), self.hardware_filter_allowed(), self.config.canid)
+        elif self.can.opcode_filter is not None:
+            self.can.set_filters(None)
 
     def set_sent_message_handler(self, sent_message_handler) -> None:
         self.sent_message_handler = sent_message_handler
 
-    async def send_cbus_message(self, msg: canmessage.canmessage) -> None:
+    async def send_cbus_message(self, msg: canmessage.canmessage, wait_for_completion: bool = False) -> int:
         # self.logger.log(f'cbus: send_cbus_message: sending {msg}')
         if msg.canid == 0:
             msg.canid = self.config.canid
         msg.make_header()
-        await self.send_cbus_message_no_header_update(msg)
+        return await self.send_cbus_message_no_header_update(msg, wait_for_completion)
 
-    async def send_cbus_message_no_header_update(self, msg) -> None:
+    async def send_cbus_message_no_header_update(self, msg, wait_for_completion: bool = False) -> int:
         # self.logger.log(f'cbus: send_cbus_message_no_header_update: sending {msg}')
-        self.can.send_message__(msg)
+        # returns the CAN driver's result, non-zero if a frame waited for was not sent
+        r = await self.can.queue_message(msg, wait_for_completion)
+
+        if r:
+            return r
+
         self.has_ui and self.config.mode == MODE_FLIM and self.led_grn.pulse()
         self.num_messages_sent += 1
 
@@ -187,10 +276,14 @@ class cbus:
 
         if self.consume_own_messages:
             if msg.matches(self.consume_query_type, self.consume_query):
-                msg.canid = 0
-                await self.can.rx_queue.enqueue(msg)
+                # a copy, as the sender may still hold the message and the transmit queue may not have sent it
+                own = msg.copy()
+                own.canid = 0
+                await self.can.rx_queue.enqueue(own)
                 self.callback_flag.set()
 
+        return r
+
     async def process(self, max_msgs: int = 10) -> None:
         while True:
 
@@ -262,23 +355,28 @@ class cbus:
                         self.num_messages_received += 1
 
                         if msg.ext:
+                            msg.release()
                             continue
 
+                        # the same frame goes to every consumer below, see canmessage.messagepool
+                        # none may change it, which is only checked in pool debug mode
+                        msg.freeze()
+
                         if self.received_message_handler is not None:
-                            if self.opcodes is not None and len(self.opcodes) > 0 and msg.data[0] in self.opcodes:
-                                self.received_message_handler(msg)
-                            else:
+                            if not self.opcodes or (msg.dlc > 0 and msg.data[0] in self.opcodes):
                                 self.received_message_handler(msg)
 
                         for h in self.histories:
                             h.add(msg)
 
-                        for sub in self.subscriptions:
-                            # self.logger.log(f'cbus: publishing to {sub.name}')
-                            sub.publish(msg)
+                        # only to the subscriptions that can match the frame
+                        self.router.publish(msg)
+
+                        if self.router.blocked:
+                            await self.router.drain()
 
                         if self.gridconnect_server:
-                            self.gridconnect_server.output_queue.put_nowait(msg)
+                            self.gridconnect_server.output_queue.put_nowait(msg.retain())
 
                         if self.config.mode == MODE_FLIM and self.has_ui:
                             self.led_grn.pulse()
@@ -288,12 +386,19 @@ class cbus:
                             self.enumeration_required = True
 
                         if msg.dlc > 0:
-                            try:
-                                # self.logger.log(f'cbus: handling opcode = {msg.data[0]:#x}')
-                                await self.func_dict.get(msg.data[0])(msg)
-                            except TypeError:
-                                # self.logger.log(f'cbus: unhandled opcode = {msg.data[0]:#x}')
-                                pass
+                            opcode = msg.data[0]
+                            self.opcode_counts[opcode] += 1
+                            kind = self.handler_kinds[opcode]
+
+                            if kind != HANDLER_NONE:
+                                # self.logger.log(f'cbus: handling opcode = {opcode:#x}')
+                                try:
+                                    if kind == HANDLER_ASYNC:
+                                        await self.handlers[opcode](msg)
+                                    else:
+                                        self.handlers[opcode](msg)
+                                except Exception as e:
+                                    self.logger.log(f'cbus: handler for opcode {opcode:#x} failed, exception = {e}')
 
                         else:
                             if self.config.node_number > 0:
@@ -302,6 +407,8 @@ class cbus:
                                 elif self.enumerating:
                                     self.enum_responses.append(msg.get_canid())
 
+                        # dispatch is complete, return a pooled frame to the receive pool
+                        msg.release()
                         processed_msgs += 1
 
                     else:
@@ -360,6 +467,7 @@ class cbus:
 
         if self.in_transition:
             self.config.set_node_number(msg.get_node_number())
+            self.update_filters()
             await self.send_nn_ack()
 
             self.in_transition = False
@@ -375,6 +483,7 @@ class cbus:
                 await self.send_CMDERR(7)
             else:
                 self.config.set_canid(msg.data[3])
+                self.update_filters()
                 await self.send_nn_ack()
 
     async def handle_enum(self, msg: canmessage.canmessage) -> None:
@@ -428,45 +537,71 @@ class cbus:
         # self.logger.log('RQEVN')
 
         if msg.get_node_number() == self.config.node_number:
-            num_events = self.config.count_events()
             omsg = canmessage.canmessage(self.config.canid, 4)
             omsg.data[0] = cbusdefs.OPC_NUMEV
             omsg.data[1] = msg.data[1]
             omsg.data[2] = msg.data[2]
-            omsg.data[3] = num_events
+            omsg.data[3] = min(self.config.count_events(), 0xff)
             await self.send_cbus_message(omsg)
 
     async def handle_nerd(self, msg: canmessage.canmessage) -> None:
         # self.logger.log('NERD')
 
         if msg.get_node_number() == self.config.node_number:
-            omsg = canmessage.canmessage(canid=self.config.canid, dlc=8)
-            omsg.data[0] = cbusdefs.OPC_ENRSP
-            omsg.data[1] = msg.data[1]
-            omsg.data[2] = msg.data[2]
+            self.start_bulk_reply(self.send_event_table(msg.data[1], msg.data[2]))
+
+    def start_bulk_reply(self, coro) -> None:
+        # a new request replaces a reply still in progress
+        if self.bulk_reply_task is not None:
+            self.bulk_reply_task.cancel()
+        self.bulk_reply_task = asyncio.create_task(coro)
+
+    async def send_event_table(self, nn_hi: int, nn_lo: int) -> None:
+        # one ENRSP per stored event with an index up to MAX_EVENT_INDEX, those beyond are left out and counted
+        # each frame is sent before the next is queued, so the dump is paced by the bus and leaves the
+        # transmit queue free for other traffic, and received frames are processed between frames
+        omsg = canmessage.canmessage(canid=self.config.canid, dlc=8)
+        omsg.data[0] = cbusdefs.OPC_ENRSP
+        omsg.data[1] = nn_hi
+        omsg.data[2] = nn_lo
+        events = self.config.events
+        size = self.config.event_size
+        remaining = self.config.count_events()
+
+        for i in range(min(self.config.num_events, MAX_EVENT_INDEX + 1)):
+            if remaining == 0:
+                break
 
-            for i in range(self.config.num_events):
-                event = self.config.read_event(i)
-                if (
-                        event[0] == 0xff
-                        and event[1] == 0xff
-                        and event[2] == 0xff
-                        and event[3] == 0xff
-                ):
-                    pass
-                else:
-                    omsg.data[3] = event[0]
-                    omsg.data[4] = event[1]
-                    omsg.data[5] = event[2]
-                    omsg.data[6] = event[3]
-                    omsg.data[7] = i
-                    await self.send_cbus_message(omsg)
-                    time.sleep_ms(10)
+            if self.config.slot_in_use(i):
+                offset = i * size
+                omsg.data[3] = events[offset]
+                omsg.data[4] = events[offset + 1]
+                omsg.data[5] = events[offset + 2]
+                omsg.data[6] = events[offset + 3]
+                omsg.data[7] = i
+                if await self.send_cbus_message(omsg, wait_for_completion=True):
+                    self.logger.log('cbus: event table reply abandoned, frame not sent')
+                    break
+                remaining -= 1
+        else:
+            if remaining > 0:
+                self.logger.log(f'cbus: {remaining} events have an index above {MAX_EVENT_INDEX} and were not sent')
+
+        self.bulk_reply_task = None
 
     async def handle_reval(self, msg: canmessage.canmessage) -> None:
         # self.logger.log('REVAL')
 
         if msg.get_node_number() == self.config.node_number:
+            # the index must name a stored event, and one from an earlier NERD may be stale in a sorted table
+            idx = msg.data[3]
+            if idx >= self.config.num_events or not self.config.slot_in_use(idx):
+                await self.send_CMDERR(7)
+                return
+            if msg.data[4] < 1 or msg.data[4] > self.config.num_evs:
+                await self.send_CMDERR(6)
+                return
+
             omsg = canmessage.canmessage(canid=self.config.canid, dlc=6)
             omsg.data[0] = cbusdefs.OPC_NEVAL
             omsg.data[1] = msg.data[1]
@@ -484,6 +619,7 @@ class cbus:
                 and self.in_learn_mode
         ):
             self.config.clear_all_events()
+            self.update_filters()
             await self.send_WRACK()
 
     async def handle_nnevn(self, msg: canmessage.canmessage) -> None:
@@ -494,7 +630,7 @@ class cbus:
             omsg.data[0] = cbusdefs.OPC_EVNLF
             omsg.data[1] = msg.data[1]
             omsg.data[2] = msg.data[2]
-            omsg.data[3] = self.config.num_events - self.config.count_events()
+            omsg.data[3] = min(self.config.count_free_slots(), 0xff)
             await self.send_cbus_message(omsg)
 
     async def handle_qnn(self, msg: canmessage.canmessage) -> None:
@@ -532,6 +668,7 @@ class cbus:
                     msg.data[5],
                     msg.data[6],
             ):
+                self.update_filters()
                 await self.send_WRACK()
             else:
                 await self.send_CMDERR(10)
@@ -544,6 +681,7 @@ class cbus:
                     msg.get_node_number(),
                     msg.get_event_number(),
             ):
+                self.update_filters()
                 await self.send_WRACK()
             else:
                 await self.send_CMDERR(10)
@@ -611,6 +749,7 @@ class cbus:
         if new_id > 0:
             self.logger.log(f'cbus: took unused can id = {new_id}')
             self.config.set_canid(new_id)
+            self.update_filters()
             await self.send_nn_ack()
         else:
             await self.send_CMDERR(7)
@@ -641,6 +780,7 @@ class cbus:
         self.config.set_mode(MODE_SLIM)
         self.config.set_canid(0)
         self.config.set_node_number(0)
+        self.update_filters()
         self.indicate_mode(MODE_SLIM)
 
     def indicate_mode(self, mode: int) -> None:
@@ -660,24 +800,35 @@ class cbus:
 
     def set_gcserver(self, server: gcserver.gcserver) -> None:
         self.gridconnect_server = server
+        self.update_filters()
 
     def add_history(self, history) -> None:
         # self.logger.log(f'cbus: add history, query type = {history.query_type}, query = {history.query}')
         self.histories.append(history)
+        self.update_filters()
 
     def remove_history(self, history: cbushistory.cbushistory) -> None:
         for i, h in enumerate(self.histories):
             if h.id == history.id:
                 del self.histories[i]
+        self.update_filters()
 
     def add_subscription(self, sub: cbuspubsub.subscription) -> None:
         # self.logger.log(
         #     f'cbus: add subscription, name = {sub.name}, id = {sub.id}, query type = {sub.query_type}, query = {sub.query}')
         self.subscriptions.append(sub)
+        self.router.add(sub)
+        self.update_filters()
+
+    def subscription_stats(self) -> list:
+        # (name, (delivered, dropped, coalesced, high-water mark, queued)) for each subscription
+        return [(sub.name, sub.stats()) for sub in self.subscriptions]
 
     def remove_subscription(self, sub: cbuspubsub.subscription) -> None:
         # self.logger.log(f'cbus: remove subscription, id = {sub.id}')
         for i, s in enumerate(self.subscriptions):
             if s.id == sub.id:
                 del self.subscriptions[i]
+                self.router.remove(s)
                 break
+        self.update_filters()
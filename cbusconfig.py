@@ -1,7 +1,10 @@
 # cbusconfig.py
 
+import array
 import gc
+import time
 
+import uasyncio as asyncio
 from micropython import const
 
 import cbus
@@ -16,10 +19,12 @@ FILES_EVENTS_FILENAME = const('/events.dat')
 # JSON_EVENTS_FILE_NAME = const('/events.json')
 
 CONFIG_TYPE_FILES = const(0)
-
-
 # CONFIG_TYPE_JSON = const(1)
-# CONFIG_TYPE_I2C_EEPROM = const(2)
+CONFIG_TYPE_I2C_EEPROM = const(2)
+CONFIG_TYPE_JOURNAL = const(3)
+
+# records added at a time as a sorted event table grows
+EVENT_TABLE_CHUNK = const(32)
 
 
 class storage_backend:
@@ -30,6 +35,7 @@ class storage_backend:
         self.logger = logger.logger()
         self.storage_type = storage_type
         self.ev_offset = ev_offset
+        self.bytes_written = 0
 
     def init_config(self, config):
         pass
@@ -49,6 +55,10 @@ class storage_backend:
     def store_events(self, events):
         pass
 
+    def store_events_records(self, events, runs):
+        # runs is a list of (offset, length) of changed bytes, backends without record writes store everything
+        self.store_events(events)
+
     def init_nvs(self, nvs):
         pass
 
@@ -58,6 +68,13 @@ class storage_backend:
     def store_nvs(self, nvs):
         pass
 
+    def store_nvs_records(self, nvs, runs):
+        self.store_nvs(nvs)
+
+    def check_capacity(self, config_len: int, nvs_len: int, events_len: int) -> None:
+        # raises ValueError if the backend cannot hold data of these sizes
+        pass
+
 
 # backend using binary files
 
@@ -66,11 +83,34 @@ class files_backend(storage_backend):
         self.logger = logger.logger()
         super().__init__(ev_offset)
 
-    def init_config(self, config):
-        f = open(FILES_CONFIG_FILENAME, 'wb')
-        f.write(bytearray(config))
+    def write_file(self, filename, data):
+        f = open(filename, 'wb')
+        f.write(bytearray(data))
+        f.close()
+        self.bytes_written += len(data)
+
+    def write_records(self, filename, data, runs):
+        # rewrite only the changed byte runs, in place
+        # littlefs commits a file's changes atomically when it is closed, so a power loss leaves either the old
+        # or the new contents, never a partly written record
+        try:
+            f = open(filename, 'r+b')
+        except OSError:
+            self.write_file(filename, data)
+            return
+
+        mv = memoryview(data)
+
+        for offset, length in runs:
+            f.seek(offset)
+            f.write(mv[offset: offset + length])
+            self.bytes_written += length
+
         f.close()
 
+    def init_config(self, config):
+        self.write_file(FILES_CONFIG_FILENAME, config)
+
     def load_config(self, data_len):
         try:
             f = open(FILES_CONFIG_FILENAME, 'rb')
@@ -86,14 +126,10 @@ class files_backend(storage_backend):
         return bytearray(data)
 
     def store_config(self, config):
-        f = open(FILES_CONFIG_FILENAME, 'wb')
-        f.write(bytearray(config))
-        f.close()
+        self.write_file(FILES_CONFIG_FILENAME, config)
 
     def init_events(self, events):
-        f = open(FILES_EVENTS_FILENAME, 'wb')
-        f.write(bytearray(events))
-        f.close()
+        self.write_file(FILES_EVENTS_FILENAME, events)
 
     def load_events(self, ev_size):
         try:
@@ -110,14 +146,13 @@ class files_backend(storage_backend):
         return bytearray(data)
 
     def store_events(self, events):
-        f = open(FILES_EVENTS_FILENAME, 'wb')
-        f.write(bytearray(events))
-        f.close()
+        self.write_file(FILES_EVENTS_FILENAME, events)
+
+    def store_events_records(self, events, runs):
+        self.write_records(FILES_EVENTS_FILENAME, events, runs)
 
     def init_nvs(self, nvs):
-        f = open(FILES_NVS_FILENAME, 'wb')
-        f.write(bytearray(nvs))
-        f.close()
+        self.write_file(FILES_NVS_FILENAME, nvs)
 
     def load_nvs(self, num_nvs):
         try:
@@ -134,10 +169,427 @@ class files_backend(storage_backend):
         return bytearray(data)
 
     def store_nvs(self, nvs):
-        f = open(FILES_NVS_FILENAME, 'wb')
-        f.write(bytearray(nvs))
+        self.write_file(FILES_NVS_FILENAME, nvs)
+
+    def store_nvs_records(self, nvs, runs):
+        self.write_records(FILES_NVS_FILENAME, nvs, runs)
+
+
+# journal backend
+#
+# changes are appended to a log of records rather than rewriting whole files, on any medium with
+# read_into(addr, buf), write_block(addr, data) and page_size, such as i2ceeprom or file_medium
+#
+# the medium is split into areas of JOURNAL_AREA_SIZE bytes, at least two, which are used in turn, so the
+# header and snapshot writes of each compaction move round the device
+# an area starts with a header: magic, generation and CRC, and the area with the highest generation is current
+# records follow: sequence, key, offset, length, data, and a CRC that also covers the area's generation,
+# so records left over from an earlier use of the area are not replayed
+# when an area fills, a snapshot of the current data is written to the next area with the next generation,
+# and its header is written last, so a power loss during compaction leaves the previous area in use
+# compaction past the threshold runs in a task that writes the snapshot a page at a time, while an area that
+# fills completely is compacted at once
+# a snapshot of all the data must fit in one area, which check_capacity() tests before anything is loaded,
+# and append() refuses a change that would make the data too big, before applying it
+
+JOURNAL_FILENAME = const('/config.jnl')
+
+JOURNAL_MAGIC = const(0x434a)
+JOURNAL_HEADER_LEN = const(8)
+JOURNAL_RECORD_HEADER_LEN = const(6)
+JOURNAL_CRC_LEN = const(2)
+JOURNAL_MAX_RECORD_DATA = const(64)
+JOURNAL_END_OF_RECORDS = const(0xff)
+JOURNAL_AREA_SIZE = const(4096)
+
+JOURNAL_KEY_CONFIG = const(0)
+JOURNAL_KEY_NVS = const(1)
+JOURNAL_KEY_EVENTS = const(2)
+
+
+def make_crc16_table() -> array.array:
+    table = array.array('H', [0] * 256)
+
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table[i] = crc & 0xffff
+
+    return table
+
+
+crc16_table = make_crc16_table()
+
+
+def crc16(data, crc: int = 0xffff) -> int:
+    # CRC-16/CCITT
+    for b in data:
+        crc = ((crc << 8) & 0xffff) ^ crc16_table[(crc >> 8) ^ b]
+    return crc
+
+
+class file_medium:
+    # a fixed-size file used as a flat address space, erased to 0xff like an EEPROM
+    def __init__(self, filename: str = JOURNAL_FILENAME, size: int = 8192, page_size: int = 256):
+        self.filename = filename
+        self.size = size
+        self.page_size = page_size
+
+        try:
+            f = open(self.filename, 'rb')
+            f.close()
+        except OSError:
+            f = open(self.filename, 'wb')
+            blank = bytearray([0xff] * self.page_size)
+            for _ in range(0, self.size, self.page_size):
+                f.write(blank)
+            f.close()
+
+    def read_into(self, addr: int, buf) -> None:
+        f = open(self.filename, 'rb')
+        f.seek(addr)
+        f.readinto(buf)
         f.close()
 
+    def write_block(self, addr: int, data) -> None:
+        f = open(self.filename, 'r+b')
+        f.seek(addr)
+        f.write(data)
+        f.close()
+
+
+class journal_backend(storage_backend):
+    def __init__(self, medium, compact_threshold: int = 75, num_areas: int = 0):
+        # num_areas of 0 divides the medium into areas of JOURNAL_AREA_SIZE bytes
+        # the layout depends only on the medium, so it is the same from one start to the next
+        self.logger = logger.logger()
+        super().__init__()
+        self.medium = medium
+        self.num_areas = num_areas if num_areas > 0 else max(2, medium.size // JOURNAL_AREA_SIZE)
+        self.area_size = medium.size // self.num_areas
+        self.compact_threshold = self.area_size * compact_threshold // 100
+        self.images = {}
+        self.area = 0
+        self.generation = 0
+        self.write_pos = JOURNAL_HEADER_LEN
+        self.snapshot_end = JOURNAL_HEADER_LEN
+        self.seq = 0
+        self.replayed = False
+        self.compact_task_handle = None
+        self.compacting = False
+        self.compact_runs = set()
+
+    def area_header(self, generation: int) -> bytearray:
+        h = bytearray(JOURNAL_HEADER_LEN)
+        h[0] = JOURNAL_MAGIC >> 8
+        h[1] = JOURNAL_MAGIC & 0xff
+        for i in range(4):
+            h[2 + i] = (generation >> (24 - (i * 8))) & 0xff
+        crc = crc16(memoryview(h)[:6])
+        h[6] = crc >> 8
+        h[7] = crc & 0xff
+        return h
+
+    def read_generation(self, area: int) -> int:
+        # the generation of a valid area header, or -1
+        h = bytearray(JOURNAL_HEADER_LEN)
+        self.medium.read_into(area * self.area_size, h)
+
+        if (h[0] << 8) + h[1] != JOURNAL_MAGIC or crc16(memoryview(h)[:6]) != (h[6] << 8) + h[7]:
+            return -1
+
+        return (h[2] << 24) + (h[3] << 16) + (h[4] << 8) + h[5]
+
+    def replay(self) -> None:
+        # find the current area and apply its records to the in-memory images
+        self.replayed = True
+        gens = [self.read_generation(a) for a in range(self.num_areas)]
+        self.generation = max(gens)
+
+        if self.generation < 0:
+            self.logger.log('journal: no valid area, formatting')
+            self.area = 0
+            self.generation = 1
+            self.medium.write_block(0, self.area_header(self.generation))
+            return
+
+        self.area = gens.index(self.generation)
+
+        # one read of the whole area, then parse it in memory
+        buf = bytearray(self.area_size)
+        self.medium.read_into(self.area * self.area_size, buf)
+        mv = memoryview(buf)
+        gen_bytes = bytes(buf[2:6])
+        pos = JOURNAL_HEADER_LEN
+        seq = 0
+
+        while pos + JOURNAL_RECORD_HEADER_LEN + JOURNAL_CRC_LEN <= self.area_size:
+            key = buf[pos + 2]
+            length = buf[pos + 5]
+            end = pos + JOURNAL_RECORD_HEADER_LEN + length
+
+            if key == JOURNAL_END_OF_RECORDS or end + JOURNAL_CRC_LEN > self.area_size:
+                break
+
+            if (buf[pos] << 8) + buf[pos + 1] != seq:
+                break
+
+            if crc16(mv[pos: end], crc16(gen_bytes)) != (buf[end] << 8) + buf[end + 1]:
+                # a record torn by a power loss, or left from an earlier generation, ends the journal
+                break
+
+            self.apply(key, (buf[pos + 3] << 8) + buf[pos + 4], mv[pos + JOURNAL_RECORD_HEADER_LEN: end])
+            pos = end + JOURNAL_CRC_LEN
+            seq = (seq + 1) & 0xffff
+
+        self.write_pos = pos
+        self.snapshot_end = JOURNAL_HEADER_LEN
+        self.seq = seq
+        self.logger.log(f'journal: area {self.area}, generation {self.generation}, {seq} records, {pos} bytes used')
+
+    def apply(self, key: int, offset: int, data) -> None:
+        img = self.images.get(key)
+
+        if img is None:
+            img = bytearray()
+            self.images[key] = img
+
+        if len(img) < offset + len(data):
+            img.extend(bytearray([0xff] * (offset + len(data) - len(img))))
+
+        img[offset: offset + len(data)] = data
+
+    def encode_records(self, key: int, data, runs, seq: int, generation: int) -> tuple:
+        # the records for the given (offset, length) runs of data, and the next sequence number
+        out = bytearray()
+        mv = memoryview(data)
+        gen_crc = crc16(bytes([(generation >> 24) & 0xff, (generation >> 16) & 0xff, (generation >> 8) & 0xff, generation & 0xff]))
+
+        for offset, length in runs:
+            while length > 0:
+                n = min(length, JOURNAL_MAX_RECORD_DATA)
+                start = len(out)
+                out.extend(bytes([seq >> 8, seq & 0xff, key, offset >> 8, offset & 0xff, n]))
+                out.extend(mv[offset: offset + n])
+                crc = crc16(memoryview(out)[start:], gen_crc)
+                out.extend(bytes([crc >> 8, crc & 0xff]))
+                seq = (seq + 1) & 0xffff
+                offset += n
+                length -= n
+
+        return out, seq
+
+    @staticmethod
+    def snapshot_len(data_len: int) -> int:
+        # bytes taken by the records of data_len bytes
+        n = (data_len + JOURNAL_MAX_RECORD_DATA - 1) // JOURNAL_MAX_RECORD_DATA
+        return data_len + n * (JOURNAL_RECORD_HEADER_LEN + JOURNAL_CRC_LEN)
+
+    def fits(self, lengths) -> bool:
+        # whether a snapshot of data of these lengths fits in an area
+        return JOURNAL_HEADER_LEN + sum(self.snapshot_len(n) for n in lengths) <= self.area_size
+
+    def check_capacity(self, config_len: int, nvs_len: int, events_len: int) -> None:
+        needed = JOURNAL_HEADER_LEN + sum(self.snapshot_len(n) for n in (config_len, nvs_len, events_len))
+
+        if needed > self.area_size:
+            raise ValueError(f'journal: {needed} bytes of data do not fit in a {self.area_size} byte area, '
+                             f'use a larger medium or fewer areas')
+
+        if needed > self.compact_threshold:
+            self.logger.log(f'journal: {needed} bytes of data leave little room for records, expect frequent compaction')
+
+    def append(self, key: int, data, runs) -> None:
+        if not self.replayed:
+            self.replay()
+
+        # refuse a change that would make the data too big for a snapshot, before it is applied
+        end = max(offset + length for offset, length in runs)
+        img = self.images.get(key)
+
+        if img is None or end > len(img):
+            lengths = [end if k == key else len(v) for k, v in self.images.items()]
+            if img is None:
+                lengths.append(end)
+            if not self.fits(lengths):
+                raise ValueError('journal: data does not fit in journal area')
+
+        for offset, length in runs:
+            self.apply(key, offset, memoryview(data)[offset: offset + length])
+
+        if self.compacting:
+            # the snapshot being written predates this change, which is added to it when it is finished
+            self.compact_runs.add((key, tuple(runs)))
+
+        records, seq = self.encode_records(key, data, runs, self.seq, self.generation)
+
+        if self.write_pos + len(records) > self.area_size:
+            # the snapshot includes the data just applied
+            self.compact()
+            return
+
+        self.medium.write_block(self.area * self.area_size + self.write_pos, records)
+        self.write_pos += len(records)
+        self.seq = seq
+        self.bytes_written += len(records)
+
+        if self.needs_compaction() and self.compact_task_handle is None:
+            self.compact_task_handle = asyncio.create_task(self.compact_task())
+
+    def needs_compaction(self) -> bool:
+        # past the threshold, with records added since the last snapshot
+        return self.write_pos >= self.compact_threshold and self.write_pos > self.snapshot_end
+
+    async def compact_task(self) -> None:
+        # compact from a task of its own, away from the caller that filled the area
+        await asyncio.sleep_ms(0)
+
+        if self.needs_compaction():
+            await self.compact_paced()
+
+        self.compact_task_handle = None
+
+    def next_area(self) -> int:
+        return self.area + 1 if self.area + 1 < self.num_areas else 0
+
+    def snapshot(self, generation: int) -> tuple:
+        # the records of all the current data, and the next sequence number
+        records = bytearray()
+        seq = 0
+
+        for key, img in self.images.items():
+            if len(img) > 0:
+                r, seq = self.encode_records(key, img, ((0, len(img)),), seq, generation)
+                records.extend(r)
+
+        return records, seq
+
+    def make_current(self, area: int, generation: int, records_len: int, seq: int) -> None:
+        # the header is written last, once every record of the snapshot is in place
+        self.medium.write_block(area * self.area_size, self.area_header(generation))
+        self.bytes_written += JOURNAL_HEADER_LEN + records_len
+
+        self.area = area
+        self.generation = generation
+        self.write_pos = JOURNAL_HEADER_LEN + records_len
+        self.snapshot_end = self.write_pos
+        self.seq = seq
+        self.logger.log(f'journal: compacted to area {area}, generation {generation}, {self.write_pos} bytes used')
+
+    async def write_paced(self, addr: int, data) -> bool:
+        # write a page at a time, yielding between pages, False if a compaction at once took over meanwhile
+        page_size = self.medium.page_size
+        mv = memoryview(data)
+        pos = 0
+
+        while pos < len(mv):
+            # a page write must not cross a page boundary
+            n = min(page_size - ((addr + pos) % page_size), len(mv) - pos)
+            self.medium.write_block(addr + pos, mv[pos: pos + n])
+            pos += n
+            await asyncio.sleep_ms(0)
+
+            if not self.compacting:
+                return False
+
+        return True
+
+    async def compact_paced(self) -> None:
+        # write the snapshot a page at a time, as each page write of an EEPROM holds the bus until the device
+        # acknowledges it
+        # changes made meanwhile are still appended to the current area, and then added to the snapshot from the
+        # current data, so a record changed more than once is added once, until none are left to add and the
+        # header can be written
+        area = self.next_area()
+        generation = self.generation + 1
+        records, seq = self.snapshot(generation)
+        pos = area * self.area_size + JOURNAL_HEADER_LEN
+        used = len(records)
+
+        self.compacting = True
+        self.compact_runs = set()
+
+        while True:
+            if not await self.write_paced(pos, records):
+                # append() filled the current area and compacted at once, which replaces this snapshot
+                return
+
+            pos += len(records)
+
+            if not self.compact_runs:
+                break
+
+            records = bytearray()
+
+            for key, runs in self.compact_runs:
+                r, seq = self.encode_records(key, self.images[key], runs, seq, generation)
+                records.extend(r)
+
+            self.compact_runs = set()
+            used += len(records)
+
+            if JOURNAL_HEADER_LEN + used > self.area_size:
+                # too many changes while the snapshot was written, write a fresh one at once
+                self.compact()
+                return
+
+        self.compacting = False
+        self.make_current(area, generation, used, seq)
+
+    def compact(self) -> None:
+        # write a snapshot of the current data to the next area, then its header to make it current
+        # this abandons a paced compaction in progress, which writes to the same area
+        self.compacting = False
+        self.compact_runs = set()
+        area = self.next_area()
+        generation = self.generation + 1
+        records, seq = self.snapshot(generation)
+
+        # append() keeps the data small enough for this to fit
+        self.medium.write_block(area * self.area_size + JOURNAL_HEADER_LEN, records)
+        self.make_current(area, generation, len(records), seq)
+
+    def load(self, key: int):
+        if not self.replayed:
+            self.replay()
+
+        img = self.images.get(key)
+        return bytearray(img) if img else None
+
+    def load_config(self, data_len):
+        return self.load(JOURNAL_KEY_CONFIG)
+
+    def init_config(self, config):
+        self.store_config(config)
+
+    def store_config(self, config):
+        self.append(JOURNAL_KEY_CONFIG, config, ((0, len(config)),))
+
+    def load_events(self, ev_size):
+        return self.load(JOURNAL_KEY_EVENTS)
+
+    def init_events(self, events):
+        self.store_events(events)
+
+    def store_events(self, events):
+        self.append(JOURNAL_KEY_EVENTS, events, ((0, len(events)),))
+
+    def store_events_records(self, events, runs):
+        self.append(JOURNAL_KEY_EVENTS, events, runs)
+
+    def load_nvs(self, num_nvs):
+        return self.load(JOURNAL_KEY_NVS)
+
+    def init_nvs(self, nvs):
+        self.store_nvs(nvs)
+
+    def store_nvs(self, nvs):
+        self.append(JOURNAL_KEY_NVS, nvs, ((0, len(nvs)),))
+
+    def store_nvs_records(self, nvs, runs):
+        self.append(JOURNAL_KEY_NVS, nvs, runs)
+
 
 # backend using json text files
 
@@ -249,17 +701,36 @@ class files_backend(storage_backend):
 
 
 class cbusconfig:
-    def __init__(self, storage_type=CONFIG_TYPE_FILES, num_nvs=20, num_events=64, num_evs=4):
+    def __init__(self, storage_type=CONFIG_TYPE_FILES, num_nvs=20, num_events=64, num_evs=4, backend=None,
+                 sorted_events=False):
         self.logger = logger.logger()
         self.storage_type = storage_type
 
+        # keep the event table sorted by (nn, en) and search it, rather than hold an index of every event in memory
+        # suits tables of thousands of events: the table only grows as events are learned, up to num_events
+        # an event's index is its position in (nn, en) order, so learning or clearing an event renumbers the
+        # events after it, and a configuration tool must read the table again (NERD) after any change
+        self.sorted_events = sorted_events
+        self.ev_indexes = {}
+
+        # stored event count and one bit per slot in use, kept up to date by every change to the event table
+        self.num_stored = 0
+        self.occupancy = bytearray((num_events + 7) >> 3)
+
         self.num_nvs = num_nvs
         self.num_events = num_events
         self.num_evs = num_evs
         self.event_size = 4 + self.num_evs
 
-        if self.storage_type == CONFIG_TYPE_FILES:
+        if backend is not None:
+            self.backend = backend
+        elif self.storage_type == CONFIG_TYPE_FILES:
             self.backend = files_backend()
+        elif self.storage_type == CONFIG_TYPE_JOURNAL:
+            self.backend = journal_backend(file_medium())
+        elif self.storage_type == CONFIG_TYPE_I2C_EEPROM:
+            import i2ceeprom
+            self.backend = journal_backend(i2ceeprom.i2ceeprom())
         # elif self.storage_type == CONFIG_TYPE_JSON:
         #     self.backend = json_backend()
         else:
@@ -270,7 +741,19 @@ class cbusconfig:
         self.node_number = 0
         self.was_reset = False
 
+        # changed event and NV records, written at once or batched by write coalescing
+        self.dirty_events = set()
+        self.dirty_nvs = set()
+        self.coalesce_writes = False
+        self.idle_time = 0
+        self.max_delay = 0
+        self.first_dirty_time = 0
+        self.last_dirty_time = 0
+        self.flush_task_handle = None
+
     def begin(self) -> None:
+        self.backend.check_capacity(10, self.num_nvs, self.num_events * self.event_size)
+
         # load or init module config data
         self.config_data = self.backend.load_config(10)
 
@@ -290,13 +773,124 @@ class cbusconfig:
             self.nvs = bytearray(0x0 for _ in range(self.num_nvs))
             self.backend.init_nvs(self.nvs)
 
-        # load or init events
+        # load or init events, a sorted table starts empty
         self.events = self.backend.load_events(self.num_events * self.event_size)
 
         if not self.events:
-            self.events = bytearray(0xff for _ in range(self.num_events * self.event_size))
+            self.events = bytearray(0xff for _ in range(0 if self.sorted_events else self.num_events * self.event_size))
             self.backend.init_events(self.events)
 
+        self.build_event_index()
+
+    def build_event_index(self) -> None:
+        # in-memory index of the event table, kept in step with self.events by write_event and clear_event
+        # event_index maps (nn << 16) + en to the slot holding that event, the first slot wins if there are duplicates
+        # free_slots holds the unused slots, highest first, so the lowest free slot is taken first
+        self.event_index = {}
+        self.free_slots = []
+        self.ev_indexes = {}
+        self.occupancy = bytearray((self.num_events + 7) >> 3)
+
+        if self.sorted_events:
+            self.sort_event_table()
+            for i in range(self.num_stored):
+                self.set_slot_used(i, True)
+
+            # keep only the stored events in memory, the blank records left in storage do no harm
+            end = self.num_stored * self.event_size
+            if len(self.events) > end:
+                self.events = self.events[:end]
+            return
+
+        # a stored table from a sorted table, or from fewer slots, is extended with blank slots
+        size = self.num_events * self.event_size
+        if len(self.events) < size:
+            self.events.extend(b'\xff' * (size - len(self.events)))
+            self.backend.store_events(self.events)
+
+        for i in range(self.num_events - 1, -1, -1):
+            offset = i * self.event_size
+            nn = (self.events[offset] << 8) + self.events[offset + 1]
+            en = (self.events[offset + 2] << 8) + self.events[offset + 3]
+
+            if nn == 0xffff and en == 0xffff:
+                self.free_slots.append(i)
+            else:
+                self.event_index[(nn << 16) + en] = i
+                self.set_slot_used(i, True)
+
+        self.num_stored = self.num_events - len(self.free_slots)
+
+        if len(self.event_index) != self.num_stored:
+            self.logger.log(f'cbusconfig: event table holds {self.num_stored - len(self.event_index)} duplicate events')
+
+    def set_slot_used(self, idx: int, state: bool) -> None:
+        if state:
+            self.occupancy[idx >> 3] |= 1 << (idx & 7)
+        else:
+            self.occupancy[idx >> 3] &= ~(1 << (idx & 7)) & 0xff
+
+    def slot_in_use(self, idx: int) -> bool:
+        return self.occupancy[idx >> 3] & (1 << (idx & 7)) != 0
+
+    def sort_event_table(self) -> None:
+        # pack the stored events at the start of the table in (nn, en) order, empty records sort last
+        size = self.event_size
+        n = len(self.events) // size
+        keys = [self.event_sort_key(i) for i in range(n)]
+        order = sorted(range(n), key=lambda i: keys[i])
+
+        if order != list(range(n)):
+            self.logger.log('cbusconfig: sorting event table')
+            table = bytearray(len(self.events))
+            for j, i in enumerate(order):
+                table[j * size: (j + 1) * size] = self.events[i * size: (i + 1) * size]
+            self.events = table
+            self.backend.store_events(self.events)
+            self.dirty_events = set()
+
+        self.num_stored = n - keys.count(0xffffffff)
+
+    def grow_event_table(self, records: int) -> None:
+        # make room for records events in a sorted table, a chunk at a time
+        # the new blank records are stored too, so the stored table never has a gap that reads back as events
+        size = self.event_size
+        have = len(self.events) // size
+
+        if records <= have:
+            return
+
+        new = min(self.num_events, max(records, have + EVENT_TABLE_CHUNK))
+        self.events.extend(bytearray(0xff for _ in range((new - have) * size)))
+        self.store_event_records(have, new - 1)
+
+    def event_sort_key(self, idx: int) -> int:
+        o = idx * self.event_size
+        return (self.events[o] << 24) + (self.events[o + 1] << 16) + (self.events[o + 2] << 8) + self.events[o + 3]
+
+    def event_position(self, nn: int, en: int) -> int:
+        # binary search of a sorted table for the first stored event not before (nn, en)
+        e = self.events
+        size = self.event_size
+        lo = 0
+        hi = self.num_stored
+
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            o = mid * size
+            mnn = (e[o] << 8) + e[o + 1]
+
+            if mnn < nn or (mnn == nn and (e[o + 2] << 8) + e[o + 3] < en):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def is_event_at(self, idx: int, nn: int, en: int) -> bool:
+        o = idx * self.event_size
+        return (self.events[o] << 8) + self.events[o + 1] == nn and (self.events[o + 2] << 8) + self.events[o + 3] == en
+
     def set_mode(self, mode: int) -> None:
         self.config_data[0] = mode
         self.backend.store_config(self.config_data)
@@ -322,59 +916,178 @@ class cbusconfig:
             # zero the NN for short events
             nn = 0
 
-        for i in range(self.num_events):
-            offset = i * self.event_size
+        if self.sorted_events:
+            idx = self.event_position(nn, en)
+            return idx if idx < self.num_stored and self.is_event_at(idx, nn, en) else -1
 
-            if ((self.events[offset] << 8) + self.events[offset + 1]) == nn and (
-                    (self.events[offset + 2] << 8) + self.events[offset + 3]) == en:
-                return i
+        return self.event_index.get((nn << 16) + en, -1)
 
-        return -1
+    def stored_slots(self) -> list:
+        if self.sorted_events:
+            return list(range(self.num_stored))
+        return sorted(self.event_index.values())
+
+    def ev_index(self, evnum: int) -> array.array:
+        # the stored slots ordered by the value of one EV, then by slot
+        # built on first use and discarded when the event table changes
+        idx = self.ev_indexes.get(evnum)
+
+        if idx is None:
+            offset = 4 + (evnum - 1)
+            size = self.event_size
+            idx = array.array('H', sorted(self.stored_slots(), key=lambda i: (self.events[i * size + offset] << 16) + i))
+            self.ev_indexes[evnum] = idx
+
+        return idx
+
+    def ev_position(self, idx: array.array, evnum: int, evval: int) -> int:
+        # binary search of an EV index for the first slot with an EV value not below evval
+        offset = 4 + (evnum - 1)
+        lo = 0
+        hi = len(idx)
+
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if self.events[idx[mid] * self.event_size + offset] < evval:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
 
     def find_event_by_ev(self, evnum: int, evval: int) -> int:
-        for i in range(self.num_events):
-            if self.read_event_ev(i, evnum) == evval:
-                return i
+        idx = self.ev_index(evnum)
+        pos = self.ev_position(idx, evnum, evval)
+
+        if pos < len(idx) and self.read_event_ev(idx[pos], evnum) == evval:
+            return idx[pos]
+
         return -1
 
     # test ... mod.cbus.config.find_event_by_evs(((1, 3), (2, 6), (3, 9), (4, 12),))
 
     def find_event_by_evs(self, query: tuple[tuple[int, int], ...]) -> int:
-        for i in range(self.num_events):
+        if len(query) == 0:
+            return -1
+
+        # candidates share the first EV value, in slot order
+        evnum, evval = query[0]
+        idx = self.ev_index(evnum)
+
+        for pos in range(self.ev_position(idx, evnum, evval), len(idx)):
+            i = idx[pos]
+
+            if self.read_event_ev(i, evnum) != evval:
+                break
+
             found = True
-            for j in range(len(query)):
+            for j in range(1, len(query)):
                 if self.read_event_ev(i, query[j][0]) != query[j][1]:
                     found = False
                     break
             if found:
                 return i
+
         return -1
 
     def find_event_space(self) -> int:
-        for i in range(self.num_events):
-            offset = i * self.event_size
+        if self.sorted_events:
+            return self.num_stored if self.num_stored < self.num_events else -1
+
+        return self.free_slots[-1] if self.free_slots else -1
+
+    def set_write_coalescing(self, state: bool = True, idle_time: int = 250, max_delay: int = 2000) -> None:
+        # batch changed event and NV records, and write them once no change has been made for idle_time ms,
+        # or max_delay ms after the first unwritten change
+        # changes not yet written are lost on a power failure, but the stored files are always consistent
+        self.idle_time = idle_time
+        self.max_delay = max_delay
+        self.coalesce_writes = state
+
+        if not state:
+            self.flush()
+
+    @staticmethod
+    def record_runs(records, size: int) -> list:
+        # (offset, length) of each run of adjacent records
+        runs = []
+
+        for r in sorted(records):
+            offset = r * size
+            if runs and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1] = (runs[-1][0], runs[-1][1] + size)
+            else:
+                runs.append((offset, size))
+
+        return runs
+
+    def store_event_record(self, idx: int) -> None:
+        self.dirty_events.add(idx)
+        self.records_changed()
+
+    def store_event_records(self, first: int, last: int) -> None:
+        self.dirty_events.update(range(first, last + 1))
+        self.records_changed()
+
+    def store_nv_record(self, idx: int) -> None:
+        self.dirty_nvs.add(idx)
+        self.records_changed()
+
+    def records_changed(self) -> None:
+        if not self.coalesce_writes:
+            self.flush()
+            return
+
+        now = time.ticks_ms()
+        self.last_dirty_time = now
+
+        if self.flush_task_handle is None:
+            self.first_dirty_time = now
+            self.flush_task_handle = asyncio.create_task(self.flush_when_idle())
+
+    async def flush_when_idle(self) -> None:
+        while True:
+            await asyncio.sleep_ms(min(self.idle_time, self.max_delay))
+            now = time.ticks_ms()
 
             if (
-                    self.events[offset] == 0xff
-                    and self.events[offset + 1] == 0xff
-                    and self.events[offset + 2] == 0xff
-                    and self.events[offset + 3] == 0xff
+                    time.ticks_diff(now, self.last_dirty_time) >= self.idle_time
+                    or time.ticks_diff(now, self.first_dirty_time) >= self.max_delay
             ):
-                return i
+                break
 
-        return -1
+        self.flush_task_handle = None
+        self.flush()
+
+    def flush(self) -> None:
+        # write any changed records now
+        if self.dirty_events:
+            self.backend.store_events_records(self.events, self.record_runs(self.dirty_events, self.event_size))
+            self.dirty_events = set()
+
+        if self.dirty_nvs:
+            self.backend.store_nvs_records(self.nvs, self.record_runs(self.dirty_nvs, 1))
+            self.dirty_nvs = set()
 
     def read_event(self, index: int) -> bytearray:
         offset = self.event_size * index
         return self.events[offset: offset + self.event_size]
 
     def write_event(self, nn: int, en: int, evnum: int, evval: int) -> bool:
+        self.ev_indexes = {}
+
+        if self.sorted_events:
+            return self.write_sorted_event(nn, en, evnum, evval)
+
         idx = self.find_existing_event(nn, en)
 
         if idx < 0:
-            idx = self.find_event_space()
-            if idx < 0:
+            if not self.free_slots:
                 return False
+            idx = self.free_slots.pop()
+            self.set_slot_used(idx, True)
+            self.num_stored += 1
+            self.event_index[(nn << 16) + en] = idx
 
         offset = idx * self.event_size
         self.events[offset] = int(nn >> 8)
@@ -383,15 +1096,43 @@ class cbusconfig:
         self.events[offset + 3] = en & 0xff
         self.events[offset + 4 + (evnum - 1)] = evval
 
-        self.backend.store_events(self.events)
+        self.store_event_record(idx)
+        return True
+
+    def write_sorted_event(self, nn: int, en: int, evnum: int, evval: int) -> bool:
+        size = self.event_size
+        idx = self.event_position(nn, en)
+        last = idx
+
+        if not (idx < self.num_stored and self.is_event_at(idx, nn, en)):
+            if self.num_stored >= self.num_events:
+                return False
+
+            # open a blank record at idx, events learned in ascending order are appended without moving any
+            self.grow_event_table(self.num_stored + 1)
+            last = self.num_stored
+            self.events[(idx + 1) * size: (last + 1) * size] = self.events[idx * size: last * size]
+            self.events[idx * size: (idx + 1) * size] = bytearray([0xff] * size)
+            self.num_stored += 1
+            self.set_slot_used(last, True)
+
+            offset = idx * size
+            self.events[offset] = int(nn >> 8)
+            self.events[offset + 1] = nn & 0xff
+            self.events[offset + 2] = int(en >> 8)
+            self.events[offset + 3] = en & 0xff
+
+        self.events[idx * size + 4 + (evnum - 1)] = evval
+        self.store_event_records(idx, last)
         return True
 
     def read_event_ev(self, idx: int, evnum: int) -> int:
         return self.events[(idx * self.event_size) + 4 + (evnum - 1)]
 
     def write_event_ev(self, idx, evnum: int, evval: int) -> None:
+        self.ev_indexes = {}
         self.events[(idx * self.event_size) + 4 + (evnum - 1)] = evval
-        self.backend.store_events(self.events)
+        self.store_event_record(idx)
 
     def clear_event(self, nn: int, en: int) -> bool:
         idx = self.find_existing_event(nn, en)
@@ -399,37 +1140,81 @@ class cbusconfig:
         if idx < 0:
             return False
 
+        self.ev_indexes = {}
+
+        if self.sorted_events:
+            # close the gap, leaving a blank record at the end
+            size = self.event_size
+            last = self.num_stored - 1
+            self.events[idx * size: last * size] = self.events[(idx + 1) * size: (last + 1) * size]
+            self.events[last * size: (last + 1) * size] = bytearray([0xff] * size)
+            self.num_stored -= 1
+            self.set_slot_used(last, False)
+            self.store_event_records(idx, last)
+            return True
+
         for i in range(self.event_size):
-            self.events[(idx * self.event_size) + 1] = 0xff
+            self.events[(idx * self.event_size) + i] = 0xff
+
+        key = (nn << 16) + en
+        del self.event_index[key]
+        self.insert_free_slot(idx)
+        self.set_slot_used(idx, False)
+        self.num_stored -= 1
+
+        # if the table held another copy of the event, index that instead
+        if len(self.event_index) < self.num_stored:
+            for i in range(self.num_events):
+                if self.slot_in_use(i) and self.is_event_at(i, nn, en):
+                    self.event_index[key] = i
+                    break
 
-        self.backend.store_events(self.events)
+        self.store_event_record(idx)
         return True
 
-    def count_events(self) -> int:
-        count = 0
+    def insert_free_slot(self, idx: int) -> None:
+        # keep free_slots highest first
+        lo = 0
+        hi = len(self.free_slots)
 
-        for i in range(self.num_events):
-            t = self.read_event(i)
-            if t[0] == 0xff and t[1] == 0xff and t[2] == 0xff and t[3] == 0xff:
-                pass
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if self.free_slots[mid] > idx:
+                lo = mid + 1
             else:
-                count += 1
+                hi = mid
+
+        self.free_slots.insert(lo, idx)
+
+    def count_events(self) -> int:
+        return self.num_stored
 
-        return count
+    def count_free_slots(self) -> int:
+        return self.num_events - self.num_stored
 
     def clear_all_events(self) -> None:
-        self.events = bytearray([0xff] * (self.num_events * self.event_size))
-        self.backend.store_events(self.events)
+        self.dirty_events = set()
+
+        if self.sorted_events:
+            # every stored event lies within the table in memory, so blank only that much, and start again empty
+            if len(self.events) > 0:
+                self.backend.store_events(b'\xff' * len(self.events))
+            self.events = bytearray()
+        else:
+            self.events = bytearray(b'\xff' * (self.num_events * self.event_size))
+            self.backend.store_events(self.events)
+
+        self.build_event_index()
 
     def read_nv(self, nvnum: int) -> int:
         return self.nvs[nvnum - 1]
 
     def write_nv(self, nvnum: int, value: int) -> None:
         self.nvs[nvnum - 1] = value
-        self.backend.store_nvs(self.nvs)
+        self.store_nv_record(nvnum - 1)
 
     def print_event_table(self, hex: bool = True, print_all: bool = False) -> None:
-        for i in range(self.num_events):
+        for i in range(len(self.events) // self.event_size):
             if print_all or (self.events[i * self.event_size] < 0xff):
                 print(f'{i:3} = ', end='')
                 for j in range(0, self.event_size):
@@ -452,10 +1237,10 @@ class cbusconfig:
             self.logger.log('reset_module')
             self.config_data = bytearray(0x0 for _ in range(10))
             self.nvs = bytearray(0x0 for _ in range(self.num_nvs))
-            self.events = bytearray(0xff for _ in range(self.num_events * self.event_size))
+            self.dirty_nvs = set()
             self.backend.store_config(self.config_data)
             self.backend.store_nvs(self.nvs)
-            self.backend.store_events(self.events)
+            self.clear_all_events()
             self.set_reset_flag(True)
             self.reboot()
         else:
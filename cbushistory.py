@@ -1,5 +1,6 @@
 # CBUS event history
 
+import array
 import time
 from random import randint
 
@@ -8,6 +9,7 @@ from micropython import const
 
 import canmessage
 import cbus
+import cbustime
 import logger
 
 ORDER_ANY = const(0)
@@ -26,39 +28,141 @@ WHICH_EARLIEST = const(1)
 WHICH_LATEST = const(2)
 
 
-class historyitem:
-    def __init__(self, msg):
-        self.msg = msg
-        self.arrival_time = time.ticks_ms()
+DEFAULT_CAPACITY = const(32)
 
 
 class cbushistory:
+    # received messages are kept as packed records in a ring buffer: opcode, the four bytes after it as
+    # node and event numbers, and arrival time
+    # the oldest record is at tail, and as records arrive in time order, expiry only advances tail
+    # times are the ticks_ms() at which each frame was read from the controller, and are compared with the
+    # wrap-safe helpers in cbustime; records in the same ms are ordered by their position
+    # with max_size = -1 the buffer doubles in size when full
+    #
+    # index maps the event key of each event (polarity, nn, en) held to [count, oldest position, newest position],
+    # other frames are not indexed
+    # and links chains each record to the next record of the same key, so the oldest can be dropped in O(1)
+
     def __init__(self, cbus: cbus.cbus, max_size: int = -1, time_to_live: int = 10000, query_type: int = 11,
                  query=None) -> None:
         self.logger = logger.logger()
-        self.history = []
         self.max_size = max_size
         self.time_to_live = time_to_live
         self.query_type = query_type
         self.query = query
+        self.compiled_query = canmessage.compile_query(query_type, query)
         self.id = randint(0, 65535)  # TODO: check unique
         self.cbus = cbus
         self.add_evt = asyncio.Event()
         self.last_update = 0
-        self.last_item_received = None
+        self.allocate(max_size if max_size > 0 else DEFAULT_CAPACITY)
         self.cbus.add_history(self)
 
         asyncio.create_task(self.reaper())
 
+    def allocate(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.opcodes = bytearray(capacity)
+        self.nns = array.array('H', (0 for _ in range(capacity)))
+        self.ens = array.array('H', (0 for _ in range(capacity)))
+        self.times = array.array('L', (0 for _ in range(capacity)))
+        self.links = array.array('H' if capacity <= 0xffff else 'L', (0 for _ in range(capacity)))
+        self.index = {}
+        self.tail = 0
+        self.size = 0
+
+    def grow(self) -> None:
+        old = (self.opcodes, self.nns, self.ens, self.times)
+        positions = list(self.positions())
+        self.allocate(self.capacity * 2)
+
+        for i in positions:
+            self.append(old[0][i], old[1][i], old[2][i], old[3][i])
+
+    def key_at(self, i: int) -> int:
+        return canmessage.event_key(self.polarity_at(i), self.nns[i], self.ens[i])
+
+    def append(self, opcode: int, nn: int, en: int, t: int) -> None:
+        i = self.tail + self.size
+        if i >= self.capacity:
+            i -= self.capacity
+
+        self.opcodes[i] = opcode
+        self.nns[i] = nn
+        self.ens[i] = en
+        self.times[i] = t
+        self.size += 1
+
+        # only events are indexed, other frames have no event key
+        if not self.is_event_at(i):
+            return
+
+        key = self.key_at(i)
+        entry = self.index.get(key)
+
+        if entry is None:
+            self.index[key] = [1, i, i]
+        else:
+            self.links[entry[2]] = i
+            entry[0] += 1
+            entry[2] = i
+
+    def drop_oldest(self) -> None:
+        i = self.tail
+
+        if self.is_event_at(i):
+            key = self.key_at(i)
+            entry = self.index[key]
+
+            if entry[0] == 1:
+                del self.index[key]
+            else:
+                entry[0] -= 1
+                entry[1] = self.links[i]
+
+        self.tail = i + 1 if i + 1 < self.capacity else 0
+        self.size -= 1
+
+    def chain(self, entry: list):
+        # positions of one key's records, oldest first
+        i = entry[1]
+        for _ in range(entry[0]):
+            yield i
+            i = self.links[i]
+
+    def entries(self, event: tuple) -> tuple:
+        # the index entries for an event tuple, both polarities for POLARITY_EITHER
+        if event[0] == canmessage.POLARITY_EITHER:
+            return tuple(e for e in (self.index.get(canmessage.event_key(canmessage.POLARITY_OFF, event[1], event[2])),
+                                     self.index.get(canmessage.event_key(canmessage.POLARITY_ON, event[1], event[2])))
+                         if e is not None)
+
+        entry = self.index.get(canmessage.event_key(event[0], event[1], event[2]))
+        return () if entry is None else (entry,)
+
+    def positions(self):
+        # buffer positions from oldest to newest
+        i = self.tail
+        for _ in range(self.size):
+            yield i
+            i += 1
+            if i == self.capacity:
+                i = 0
+
     def add(self, msg: canmessage.canmessage) -> None:
-        if not (self.max_size == -1 or len(self.history) < self.max_size):
-            del self.history[0]
-
-        if msg.matches(self.query_type, self.query):
-            h = historyitem(msg)
-            self.history.append(h)
-            self.last_item_received = h
-            self.last_update = time.ticks_ms()
+        if msg.matches(self.query_type, self.compiled_query):
+            if self.size == self.capacity:
+                if self.max_size == -1:
+                    self.grow()
+                else:
+                    self.drop_oldest()
+
+            # a frame too short to hold a node or event number records it as 0
+            d = msg.data
+            n = msg.dlc
+            self.last_update = cbustime.to_ms(msg.timestamp)
+            self.append(d[0] if n > 0 else 0, (d[1] << 8) + d[2] if n >= 3 else 0, (d[3] << 8) + d[4] if n >= 5 else 0,
+                        self.last_update)
             self.add_evt.set()
 
     def remove(self):
@@ -70,46 +174,75 @@ class cbushistory:
 
     async def reaper(self, freq: int = 500) -> None:
         while True:
-            tnow = time.ticks_ms()
-            for i in range(len(self.history) - 1, -1, -1):
-                if self.history[i].arrival_time + self.time_to_live < tnow:
-                    del self.history[i]
+            self.expire()
             await asyncio.sleep_ms(min(freq, self.time_to_live))
 
+    def expire(self) -> None:
+        tnow = time.ticks_ms()
+
+        while self.size > 0 and cbustime.has_expired(self.times[self.tail], self.time_to_live, tnow):
+            self.drop_oldest()
+
     def count(self) -> int:
-        return len(self.history)
+        return self.size
 
     def clear(self) -> None:
-        self.history = []
+        self.index = {}
+        self.tail = 0
+        self.size = 0
+
+    def ordinal(self, i: int) -> int:
+        # arrival order of the record at position i, 0 for the oldest
+        return i - self.tail if i >= self.tail else i - self.tail + self.capacity
+
+    def received_at(self, event: tuple, which: int = WHICH_ANY) -> int:
+        # position of the first or last record of an event, or -1
+        entries = self.entries(event)
+
+        if len(entries) == 0:
+            return -1
+
+        if which == WHICH_LATEST:
+            return max((e[2] for e in entries), key=self.ordinal)
+        else:
+            return min((e[1] for e in entries), key=self.ordinal)
+
+    def polarity_at(self, i: int) -> int:
+        return canmessage.POLARITY_OFF if canmessage.opcode_classes[self.opcodes[i]] & canmessage.OPC_CLASS_OFF else canmessage.POLARITY_ON
+
+    def is_event_at(self, i: int) -> bool:
+        return canmessage.opcode_classes[self.opcodes[i]] & canmessage.OPC_CLASS_EVENT != 0
 
     def display(self) -> None:
-        for i, h in enumerate(self.history):
-            sc = tuple(h.msg)
-            it = h.arrival_time
-            ds = f"{i} {sc} {it}"
+        for n, i in enumerate(self.positions()):
+            if self.is_event_at(i):
+                sc = (self.polarity_at(i), self.nns[i], self.ens[i])
+            else:
+                sc = f'{self.opcodes[i]:#x}'
+            ds = f"{n} {sc} {self.times[i]}"
             self.logger.log(ds)
 
     def last_update_time(self) -> int:
         return self.last_update
 
     def event_received(self, event: tuple, within: int = TIME_ANY) -> bool:
-        for h in self.history:
-            if h.msg.get_node_number == event[1] and h.msg.get_event_number() == event[2]:
-                if event[0] == canmessage.POLARITY_EITHER or (
-                        event[0] == canmessage.POLARITY_ON and not (h.msg.data[0] & 1)) or (
-                        event[0] == canmessage.POLARITY_OFF and (h.msg.data[0] & 1)):
-                    if within == TIME_ANY or h.arrival_time > (time.ticks_ms() - within):
-                        return True
+        tnow = time.ticks_ms()
+
+        for entry in self.entries(event):
+            if within == TIME_ANY or cbustime.is_within(self.times[entry[2]], within, tnow):
+                return True
         return False
 
     def count_of_event(self, event: tuple, within: int = TIME_ANY) -> int:
         count = 0
-        for h in self.history:
-            if h.msg.get_node_number() == event[1] and h.msg.get_event_number() == event[2]:
-                if event[0] == canmessage.POLARITY_EITHER or (
-                        event[0] == canmessage.POLARITY_ON and not (h.msg.data[0] & 1)) or (
-                        event[0] == canmessage.POLARITY_OFF and (h.msg.data[0] & 1)):
-                    if within == TIME_ANY or h.arrival_time > (time.ticks_ms() - within):
+        tnow = time.ticks_ms()
+
+        for entry in self.entries(event):
+            if within == TIME_ANY:
+                count += entry[0]
+            else:
+                for i in self.chain(entry):
+                    if cbustime.is_within(self.times[i], within, tnow):
                         count += 1
         return count
 
@@ -117,31 +250,20 @@ class cbushistory:
         return self.count_of_event(event, within) > 0
 
     def time_received(self, event: tuple, which: int = WHICH_ANY) -> int:
-        times = []
-        for h in self.history:
-            if h.msg.get_node_number() == event[1] and h.msg.get_event_number() == event[2]:
-                if event[0] == canmessage.POLARITY_EITHER or (
-                        event[0] == canmessage.POLARITY_ON and not (h.msg.data[0] & 1)) or (
-                        event[0] == canmessage.POLARITY_OFF and (h.msg.data[0] & 1)):
-                    if which == WHICH_ANY:
-                        return h.arrival_time
-                    else:
-                        times.append(h.arrival_time)
-
-        if len(times) > 0:
-            times.sort()
-            if which == WHICH_EARLIEST:
-                return times[0]
-            elif which == WHICH_LATEST:
-                return times[-1]
-
-        return TIME_NOT_FOUND
+        # WHICH_ANY gives the first in arrival order, which is also the earliest
+        i = self.received_at(event, which)
+        return TIME_NOT_FOUND if i < 0 else self.times[i]
 
     def received_before(self, event1: tuple, event2: tuple) -> bool:
-        return self.time_received(event1) < self.time_received(event2)
+        # by arrival order, which also orders events received in the same ms
+        i1 = self.received_at(event1)
+        i2 = self.received_at(event2)
+        return i1 >= 0 and i2 >= 0 and self.ordinal(i1) < self.ordinal(i2)
 
     def received_after(self, event1: tuple, event2: tuple) -> bool:
-        return self.time_received(event1) > self.time_received(event2)
+        i1 = self.received_at(event1)
+        i2 = self.received_at(event2)
+        return i1 >= 0 and i2 >= 0 and self.ordinal(i1) > self.ordinal(i2)
 
     def received_in_order(self, event1: tuple, event2: tuple, order: int = ORDER_BEFORE) -> bool:
         if order == ORDER_BEFORE:
@@ -150,38 +272,29 @@ class cbushistory:
             return self.received_after(event1, event2)
 
     def current_event_polarity(self, event: tuple) -> int:
-        state = canmessage.POLARITY_UNKNOWN
-        earliest_time = 0
-
-        for h in self.history:
-            if h.msg.get_node_number() == event[1] and h.msg.get_event_number() == event[2]:
-                if h.arrival_time > earliest_time:
-                    earliest_time = h.arrival_time
-                    state = canmessage.POLARITY_OFF if (h.msg.data[0] & 1) else canmessage.POLARITY_ON
-
-        return state
+        # the polarity of the newest record
+        i = self.received_at((canmessage.POLARITY_EITHER, event[1], event[2]), WHICH_LATEST)
+        return canmessage.POLARITY_UNKNOWN if i < 0 else self.polarity_at(i)
 
     def time_of_last_message(self, polarity: int = 2, match_events_only: bool = True) -> int:
-        latest_time = 0
+        # search back from the newest record
+        i = (self.tail + self.size) % self.capacity
 
-        for h in self.history:
-            match = False
+        for _ in range(self.size):
+            i = i - 1 if i > 0 else self.capacity - 1
 
-            if match_events_only and h.msg.is_event():
-                if polarity == canmessage.POLARITY_EITHER or (
-                        polarity == canmessage.POLARITY_OFF and h.msg.data[0] & 1) or (
-                        polarity == canmessage.POLARITY_ON and not (h.msg.data[0] & 1)):
-                    match = True
-            elif not match_events_only:
-                match = True
+            if not match_events_only:
+                return self.times[i]
 
-            if match and latest_time < h.arrival_time:
-                latest_time = h.arrival_time
+            if self.is_event_at(i):
+                if polarity == canmessage.POLARITY_EITHER or polarity == self.polarity_at(i):
+                    return self.times[i]
 
-        return latest_time
+        return 0
 
     def time_diff(self, events: tuple, within: int = TIME_ANY, timespan: int = WINDOW_ANY, which: int = WHICH_ANY) -> int | None:
         atimes = []
+        tnow = time.ticks_ms()
 
         if len(events) < 2:
             return None
@@ -192,11 +305,16 @@ class cbushistory:
             if etime == TIME_NOT_FOUND:
                 return None
             else:
-                if within == TIME_ANY or (etime > time.ticks_ms() - within):
+                if within == TIME_ANY or cbustime.is_within(etime, within, tnow):
                     atimes.append(etime)
 
-        if timespan == WINDOW_ANY or abs(atimes[-1] - atimes[0]) <= timespan:
-            return atimes[-1] - atimes[0]
+        if len(atimes) < 2:
+            return None
+
+        diff = cbustime.span(atimes[0], atimes[-1])
+
+        if timespan == WINDOW_ANY or abs(diff) <= timespan:
+            return diff
         else:
             return None
 
@@ -207,35 +325,34 @@ class cbushistory:
         return False
 
     def sequence_received(self, events: tuple, order: int = ORDER_ANY, within: int = TIME_ANY, window: int = TIME_ANY, which: int = WHICH_ANY) -> bool:
-        times = []
+        # order is checked by arrival order, and window against the times of the first and last to arrive
+        found = []
+        tnow = time.ticks_ms()
 
         if self.count() < 1 or len(events) < 1:
             return False
 
         for event in events:
-            etime = self.time_received(event, which)
+            i = self.received_at(event, which)
 
-            if etime == TIME_NOT_FOUND:
+            if i < 0 or (within != TIME_ANY and not cbustime.is_within(self.times[i], within, tnow)):
                 return False
-            else:
-                if within == TIME_ANY or (etime > time.ticks_ms() - within):
-                    times.append(etime)
-
-        if len(times) == len(events):
-            if order == ORDER_GIVEN:
-                for i in range(len(times) - 1):
-                    if times[i] > times[i + 1]:
-                        return False
-            elif order == ORDER_REVERSE:
-                for i in range(len(times) - 1):
-                    if times[i] < times[i + 1]:
-                        return False
-        else:
-            return False
+
+            found.append(self.ordinal(i))
+
+        if order == ORDER_GIVEN:
+            for k in range(len(found) - 1):
+                if found[k] > found[k + 1]:
+                    return False
+        elif order == ORDER_REVERSE:
+            for k in range(len(found) - 1):
+                if found[k] < found[k + 1]:
+                    return False
 
         if window != WINDOW_ANY:
-            times.sort()
-            if times[len(times) - 1] - times[0] > window:
+            first = (self.tail + min(found)) % self.capacity
+            last = (self.tail + max(found)) % self.capacity
+            if cbustime.span(self.times[first], self.times[last]) > window:
                 return False
 
         return True
@@ -124,7 +124,7 @@ class cbuslongmessage:
         self.bus.can.send_message(msg)
 
         ctx.sequence_num = 1
-        ctx.last_fragment_sent = time.ticks_ms
+        ctx.last_fragment_sent = time.ticks_ms()
         return True
 
     async def process(self) -> None:
@@ -154,7 +154,7 @@ class cbuslongmessage:
 
                 self.bus.can.send_message(msg)
                 cctx.sequence_num += 1
-                cctx.last_fragment_sent = time.ticks_ms
+                cctx.last_fragment_sent = time.ticks_ms()
 
             self.current_context = (self.current_context + 1) % len(self.transmit_contexts)
             await asyncio.sleep_ms(PROCESS_DELAY)
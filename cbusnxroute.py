@@ -14,6 +14,7 @@ class entry_exit:
         self.name = name
         self.cbus = cbus
         self.switch_events = switch_events
+        self.switch_keys = canmessage.event_keys(switch_events)
         self.nxroute = nxroute
         self.producer_events = producer_events
 
@@ -27,7 +28,7 @@ class entry_exit:
         self.nxroute.dispose()
 
     def udf(self, msg):
-        if tuple(msg) in self.switch_events:
+        if msg.event_key() in self.switch_keys:
             return True
 
     async def nx_run_task(self):
@@ -123,13 +123,15 @@ class sensor:
         self.name = name
         self.cbus = cbus
         self.feedback_events = feedback_events
+        self.feedback_keys = canmessage.event_keys(feedback_events)
         self.query_message = query_message
         self.state = OBJECT_STATE_AWAITING_SENSOR
         self.sub = None
 
         self.evt = asyncio.Event()
         self.evt.clear()
-        self.sub = cbuspubsub.subscription(name + ':sub', self.cbus, canmessage.QUERY_UDF, self.udf)
+        self.sub = cbuspubsub.subscription(name + ':sub', self.cbus, canmessage.QUERY_UDF, self.udf,
+                                            overflow=cbuspubsub.OVERFLOW_COALESCE)
         self.task_handle = asyncio.create_task(self.run_task())
 
         asyncio.create_task(self.sync_state())
@@ -143,10 +145,10 @@ class sensor:
         pass
 
     def udf(self, msg: canmessage.cbusevent):
-        t = tuple(msg)
+        key = msg.event_key()
         if msg.is_short_event():
-            t = (t[0], 0, t[2])
-        return t in self.feedback_events
+            key &= canmessage.EVENT_KEY_SHORT_MASK
+        return key in self.feedback_keys
 
     async def sync_state(self):
         if self.query_message:
@@ -176,7 +178,7 @@ class binary_sensor(sensor):
 
     def interpret(self, msg: canmessage.cbusevent):
         # self.logger.log(f'binary_sensor {self.name}, got {msg}')
-        new_state = OBJECT_STATE_OFF if msg.data[0] & 1 else OBJECT_STATE_ON
+        new_state = OBJECT_STATE_OFF if canmessage.opcode_classes[msg.data[0]] & canmessage.OPC_CLASS_OFF else OBJECT_STATE_ON
 
         if self.state != new_state:
             self.logger.log(f'-- binary sensor: {self.name}, changed state, from {self.state} to {new_state}')
@@ -192,14 +194,15 @@ class multi_sensor(sensor):
     def __init__(self, name: str, cbus: cbus.cbus, feedback_events: tuple, query_message: tuple = None):
         super(multi_sensor, self).__init__(name, cbus, feedback_events, query_message)
 
-    def interpret(self, msg: canmessage.canmessage) -> None:
-        t = tuple(msg)
-        new_state = -1
-
+        # event key -> state, the first listed event wins
+        self.states = {}
         for n, x in enumerate(self.feedback_events):
-            if t == x:
-                new_state = n
-                break
+            key = canmessage.event_key_from_tuple(x)
+            if key not in self.states:
+                self.states[key] = n
+
+    def interpret(self, msg: canmessage.canmessage) -> None:
+        new_state = self.states.get(msg.event_key(), -1)
 
         if self.state != new_state and new_state != -1:
             self.logger.log(f'-- multi sensor: {self.name}, from {self.state} to state {new_state}')
@@ -0,0 +1,131 @@
+# cbuspattern.py
+# streaming detection of event sequences, as cbushistory.sequence_received but without keeping or rescanning a history
+
+import array
+import time
+from random import randint
+
+import uasyncio as asyncio
+from micropython import const
+
+import canmessage
+import cbus
+import cbushistory
+import cbustime
+import logger
+
+NOT_STARTED = const(-1)
+
+
+class pattern:
+    # matches a sequence of (polarity, nn, en) events as they arrive
+    #
+    # with ORDER_GIVEN (or ORDER_REVERSE) the events must arrive in that order, with any other events in between,
+    # and with ORDER_ANY each event must have been seen
+    # window limits the time from the first to the last event of a match, and within is a further limit on
+    # the same span
+    # the match is compiled once into a map from event key to the positions that event fills, and each arriving
+    # event only updates those positions
+    #
+    # registers with cbus as a subscription, so the acceptance filters and the receive path need nothing extra
+
+    def __init__(self, name: str, cbus: cbus.cbus, events: tuple, order: int = cbushistory.ORDER_GIVEN,
+                 window: int = cbushistory.WINDOW_ANY, within: int = cbushistory.TIME_ANY, once: bool = False) -> None:
+        self.logger = logger.logger()
+        self.name = name
+        self.cbus = cbus
+        self.id = randint(0, 65535)  # TODO: check unique
+        self.events = tuple(reversed(events)) if order == cbushistory.ORDER_REVERSE else tuple(events)
+        self.ordered = order != cbushistory.ORDER_ANY
+        self.once = once
+
+        spans = [x for x in (window, within) if x >= 0]
+        self.window = min(spans) if spans else -1
+
+        # as a subscription
+        self.query_type = canmessage.QUERY_TUPLES
+        self.query = self.events
+        self.compiled_query = canmessage.compile_query(self.query_type, self.query)
+
+        # event key -> positions in the sequence, highest first so one event cannot advance a match twice
+        self.positions = {}
+
+        for p, ev in enumerate(self.events):
+            pols = (canmessage.POLARITY_OFF, canmessage.POLARITY_ON) if ev[0] == canmessage.POLARITY_EITHER else (ev[0],)
+            for pol in pols:
+                key = canmessage.event_key(pol, ev[1], ev[2])
+                self.positions[key] = (p,) + self.positions.get(key, ())
+
+        # ordered: starts[i] is the start time of the most recent partial match of the first i events
+        # unordered: starts[i] is the time event i was last seen
+        self.starts = array.array('l', (NOT_STARTED for _ in range(len(self.events) + 1)))
+
+        self.evt = asyncio.Event()
+        self.match_count = 0
+        self.match_time = 0
+        self.enabled = True
+        self.cbus.add_subscription(self)
+
+    def reset(self) -> None:
+        for i in range(len(self.starts)):
+            self.starts[i] = NOT_STARTED
+
+    def remove(self) -> None:
+        self.enabled = False
+        self.cbus.remove_subscription(self)
+
+    def unsubscribe(self) -> None:
+        self.remove()
+
+    def stats(self) -> tuple:
+        # as a subscription, matches are counted as delivered
+        return self.match_count, 0, 0, 0, 0
+
+    async def wait(self):
+        await self.evt.wait()
+        self.evt.clear()
+        return self
+
+    def publish(self, msg: canmessage.canmessage) -> None:
+        if not self.enabled:
+            return
+
+        positions = self.positions.get(msg.event_key())
+
+        if positions is None:
+            return
+
+        # the time the frame was read, rather than when it reached here
+        now = cbustime.to_ms(msg.timestamp)
+
+        if self.ordered:
+            starts = self.starts
+
+            for p in positions:
+                start = now if p == 0 else starts[p]
+
+                if start != NOT_STARTED and (self.window < 0 or time.ticks_diff(now, start) <= self.window):
+                    if starts[p + 1] == NOT_STARTED or time.ticks_diff(start, starts[p + 1]) > 0:
+                        starts[p + 1] = start
+
+            start = starts[len(self.events)]
+        else:
+            for p in positions:
+                self.starts[p] = now
+
+            start = now
+            for p in range(len(self.events)):
+                t = self.starts[p]
+                if t == NOT_STARTED:
+                    return
+                if time.ticks_diff(t, start) < 0:
+                    start = t
+
+        if start != NOT_STARTED and (self.window < 0 or time.ticks_diff(now, start) <= self.window):
+            self.match_count += 1
+            self.match_time = now
+            self.reset()
+            self.evt.set()
+
+            if self.once:
+                self.remove()
@@ -1,29 +1,164 @@
 # cbuspubsub.py
 # publish/subscribe implementation of the observer pattern
 
-import re
 from random import randint
 
 import uasyncio as asyncio
+from micropython import const
 
 import canmessage
 import logger
-from primitives import Queue
+
+ROUTE_ALL_EVENTS = const(0)
+ROUTE_ANY = const(1)
+
+OVERFLOW_DROP_OLDEST = const(0)
+OVERFLOW_DROP_NEWEST = const(1)
+OVERFLOW_COALESCE = const(2)
+OVERFLOW_BLOCK = const(3)
+
+DEFAULT_QUEUE_CAPACITY = const(32)
+
+
+class messagequeue:
+    # the messages delivered to one subscription, and what to do when they arrive faster than they are taken
+    # capacity 0 is unbounded
+    # OVERFLOW_COALESCE replaces a queued message for the same event, of either polarity, with the new one at the
+    # tail, so the queue holds the latest state of each event in the order the states arrived, and drops the
+    # oldest when full
+    # OVERFLOW_BLOCK leaves the publisher to wait for evget when full
+    # queued frames are held with retain(), and the frame last taken is held until the next get() or clear()
+
+    def __init__(self, capacity: int = DEFAULT_QUEUE_CAPACITY, overflow: int = OVERFLOW_DROP_OLDEST) -> None:
+        self.capacity = capacity
+        self.overflow = overflow
+        self.items = []
+        self.keys = []
+        self.current = None
+        self.evput = asyncio.Event()
+        self.evget = asyncio.Event()
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.hwm = 0
+
+        # with OVERFLOW_COALESCE, a replaced message leaves None in items until it reaches the head
+        # positions maps an event key to the number of the put that queued its message,
+        # and its place in items is that number less the puts already taken off the head
+        self.positions = {}
+        self.num_put = 0
+        self.num_popped = 0
+        self.num_replaced = 0
+
+    def qsize(self) -> int:
+        return len(self.items) - self.num_replaced
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def full(self) -> bool:
+        return 0 < self.capacity <= self.qsize()
+
+    def put_nowait(self, msg: canmessage.canmessage) -> bool:
+        # False if the queue is full and the message must wait, only with OVERFLOW_BLOCK
+        key = canmessage.NO_EVENT_KEY
+        replaced = False
+
+        if self.overflow == OVERFLOW_COALESCE:
+            key = msg.event_key()
+
+            if key != canmessage.NO_EVENT_KEY:
+                key >>= 1
+                n = self.positions.get(key)
+                if n is not None:
+                    i = n - self.num_popped
+                    self.items[i].release()
+                    self.items[i] = None
+                    self.num_replaced += 1
+                    self.coalesced += 1
+                    replaced = True
+
+        if not replaced and self.full():
+            if self.overflow == OVERFLOW_BLOCK:
+                return False
+            elif self.overflow == OVERFLOW_DROP_NEWEST:
+                self.dropped += 1
+                return True
+            else:
+                self.pop().release()
+                self.dropped += 1
+
+        self.items.append(msg.retain())
+
+        if self.overflow == OVERFLOW_COALESCE:
+            self.keys.append(key)
+            if key != canmessage.NO_EVENT_KEY:
+                self.positions[key] = self.num_put
+            self.num_put += 1
+
+        self.delivered += 1
+        self.hwm = self.qsize() if self.qsize() > self.hwm else self.hwm
+
+        self.evput.set()
+        self.evput.clear()
+        return True
+
+    def pop(self) -> canmessage.canmessage:
+        if self.overflow != OVERFLOW_COALESCE:
+            return self.items.pop(0)
+
+        # skip the places left by replaced messages, the message that replaced each one is further on
+        while True:
+            msg = self.items.pop(0)
+            key = self.keys.pop(0)
+            self.num_popped += 1
+
+            if msg is not None:
+                break
+
+            self.num_replaced -= 1
+
+        if key != canmessage.NO_EVENT_KEY:
+            del self.positions[key]
+
+        return msg
+
+    async def get(self) -> canmessage.canmessage:
+        self.release_current()
+
+        while self.empty():
+            await self.evput.wait()
+
+        self.current = self.pop()
+        self.evget.set()
+        self.evget.clear()
+        return self.current
+
+    def release_current(self) -> None:
+        if self.current is not None:
+            self.current.release()
+            self.current = None
+
+    def clear(self) -> None:
+        while not self.empty():
+            self.pop().release()
+
+        self.release_current()
 
 
 class subscription:
-    def __init__(self, name: str, cbus, query_type: int, query):
+    def __init__(self, name: str, cbus, query_type: int, query, capacity: int = DEFAULT_QUEUE_CAPACITY,
+                 overflow: int = OVERFLOW_DROP_OLDEST):
         self.logger = logger.logger()
         self.name = name
         self.cbus = cbus
         self.id = randint(0, 65535)  # TODO: check unique
         self.query = query
         self.query_type = query_type
-        self.regex = None
+        self.compiled_query = canmessage.compile_query(query_type, query)
         self.evt = asyncio.Event()
-        self.queue = Queue()
-        if type == canmessage.QUERY_REGEX:
-            self.regex = re.compile(query)
+        self.queue = messagequeue(capacity, overflow)
+        self.blocked = None
         self.subscribe()
 
         # self.logger.log(f'subscription: query_type = {self.query_type}, query = {self.query}')
@@ -34,19 +169,127 @@ class subscription:
     def unsubscribe(self) -> None:
         self.cbus.remove_subscription(self)
 
-    def publish(self, msg: canmessage.canmessage) -> None:
+        # release a publisher waiting for room, and the frames held
+        if self.blocked is not None:
+            self.blocked.release()
+            self.blocked = None
+            self.queue.evget.set()
+            self.queue.evget.clear()
+
+        self.queue.clear()
+
+    def publish(self, msg: canmessage.canmessage) -> bool:
+        # False if the message is held until the queue has room, see router.drain()
         # self.logger.log(f'subscription: publish, query_type = {self.query_type}, query = {self.query}')
 
-        if msg.matches(self.query_type, self.query):
+        if msg.matches(self.query_type, self.compiled_query):
             # self.logger.log(f'subscription: match ok')
-            self.queue.put_nowait(msg)
+            if not self.queue.put_nowait(msg):
+                self.blocked = msg.retain()
+                return False
+
             self.evt.set()
-        else:
-            # self.logger.log('no match')
-            pass
+
+        return True
+
+    async def put_blocked(self) -> None:
+        while self.blocked is not None:
+            if self.queue.put_nowait(self.blocked):
+                self.blocked.release()
+                self.blocked = None
+                self.evt.set()
+            else:
+                await self.queue.evget.wait()
 
     async def wait(self):
+        # the frame returned is shared with every other consumer and is not read-only, change a copy() instead
         self.evt.clear()
         item = await self.queue.get()
         self.evt.set()
         return item
+
+    def stats(self) -> tuple:
+        # delivered, dropped, coalesced, high-water mark, queued
+        q = self.queue
+        return q.delivered, q.dropped, q.coalesced, q.hwm, q.qsize()
+
+
+class router:
+    # delivers each frame only to the subscriptions that can match it
+    # subscriptions are indexed by what their query selects on: event keys, opcodes and node numbers
+    # queries that cannot be indexed, such as UDFs and CAN IDs, are kept in a list that sees every frame
+    # buckets are replaced rather than changed, so a subscription may remove itself while a frame is published
+
+    def __init__(self):
+        self.by_key = {}
+        self.by_opcode = {}
+        self.by_nn = {}
+        self.unindexed = {}
+        self.routes = {}
+        self.blocked = []
+
+    def routes_for(self, sub) -> list:
+        # the (bucket, key) pairs a subscription is held under
+        query_type = sub.query_type
+        query = sub.compiled_query
+
+        if query_type in (canmessage.QUERY_TUPLES, canmessage.QUERY_TUPLE) and isinstance(query, set):
+            return [(self.by_key, key) for key in query]
+        elif query_type in (canmessage.QUERY_OPCODES, canmessage.QUERY_EVENTS):
+            return [(self.by_opcode, op) for op in set(query)]
+        elif query_type == canmessage.QUERY_LONG_MESSAGES:
+            return [(self.by_opcode, op) for op in range(256)
+                    if canmessage.opcode_classes[op] & canmessage.OPC_CLASS_LONG_MESSAGE]
+        elif query_type == canmessage.QUERY_NN:
+            return [(self.by_nn, query)]
+        elif query_type == canmessage.QUERY_EXPR and getattr(query, 'nn', None) is not None and query.nn[0] == query.nn[1]:
+            return [(self.by_nn, query.nn[0])]
+        elif query_type == canmessage.QUERY_EXPR and query.opcodes() is not None:
+            return [(self.by_opcode, op) for op in query.opcodes()]
+        elif query_type == canmessage.QUERY_ALL_EVENTS:
+            return [(self.unindexed, ROUTE_ALL_EVENTS)]
+        elif query_type == canmessage.QUERY_NONE:
+            return []
+        else:
+            return [(self.unindexed, ROUTE_ANY)]
+
+    def add(self, sub) -> None:
+        routes = self.routes_for(sub)
+
+        for bucket, key in routes:
+            bucket[key] = bucket.get(key, []) + [sub]
+
+        self.routes[id(sub)] = routes
+
+    def remove(self, sub) -> None:
+        for bucket, key in self.routes.pop(id(sub), ()):
+            subs = [s for s in bucket[key] if s is not sub]
+            if subs:
+                bucket[key] = subs
+            else:
+                del bucket[key]
+
+    def deliver(self, subs, msg: canmessage.canmessage) -> None:
+        for sub in subs:
+            if sub.publish(msg) is False:
+                self.blocked.append(sub)
+
+    def publish(self, msg: canmessage.canmessage) -> None:
+        if msg.dlc > 0:
+            key = msg.event_key()
+
+            if key != canmessage.NO_EVENT_KEY:
+                self.deliver(self.by_key.get(key, ()), msg)
+                self.deliver(self.unindexed.get(ROUTE_ALL_EVENTS, ()), msg)
+
+            self.deliver(self.by_opcode.get(msg.data[0], ()), msg)
+
+            if self.by_nn and msg.dlc > 2:
+                self.deliver(self.by_nn.get(msg.get_node_number(), ()), msg)
+
+        self.deliver(self.unindexed.get(ROUTE_ANY, ()), msg)
+
+    async def drain(self) -> None:
+        # wait for the full OVERFLOW_BLOCK subscriptions to take the frame they were published
+        while self.blocked:
+            await self.blocked.pop(0).put_blocked()
@@ -0,0 +1,287 @@
+# cbusquery.py
+# compiled message queries, for use with canmessage.QUERY_EXPR
+
+# a query is built from the functions below, which combine as they are called, e.g.
+#
+#   q = cbusquery.all_of(cbusquery.polarity(canmessage.POLARITY_ON), cbusquery.nn(100, 199),
+#                        cbusquery.negate(cbusquery.en(5)))
+#   sub = cbuspubsub.subscription('s', mod.cbus, canmessage.QUERY_EXPR, q)
+#
+# every test that depends only on the opcode (opcode sets, polarity, event and long message classes) is folded
+# into a single 256-entry table, and the remaining tests of a conjunction are integer comparisons on the frame,
+# so matching builds no tuples, unlike most UDFs
+
+import canmessage
+
+
+class conjunction:
+    # all of: an opcode table, inclusive ranges of nn, en, CAN ID and dlc, RTR and ext flags, byte masks as
+    # (index, mask, value), and any other queries
+    # unused tests are None, and combining conjunctions intersects their tables and ranges
+    # frames with no data have no opcode, and pass the table only if empty is set, as in a negated table
+
+    def __init__(self, table: bytearray = None, nn: tuple = None, en: tuple = None, canid: tuple = None,
+                 dlc: tuple = None, rtr: bool = None, ext: bool = None, masks: tuple = (), others: tuple = (),
+                 empty: bool = False) -> None:
+        self.table = table
+        self.empty = empty
+        self.nn = nn
+        self.en = en
+        self.canid = canid
+        self.dlc = dlc
+        self.rtr = rtr
+        self.ext = ext
+        self.masks = masks
+        self.others = others
+
+    def matches(self, msg: canmessage.canmessage) -> bool:
+        d = msg.data
+        n = msg.dlc
+
+        if self.table is not None:
+            if n == 0:
+                if not self.empty:
+                    return False
+            elif not self.table[d[0]]:
+                return False
+
+        if self.nn is not None:
+            if n < 3:
+                return False
+            v = (d[1] << 8) + d[2]
+            if v < self.nn[0] or v > self.nn[1]:
+                return False
+
+        if self.en is not None:
+            if n < 5:
+                return False
+            v = (d[3] << 8) + d[4]
+            if v < self.en[0] or v > self.en[1]:
+                return False
+
+        if self.canid is not None:
+            v = msg.canid & 0x7f
+            if v < self.canid[0] or v > self.canid[1]:
+                return False
+
+        if self.dlc is not None and (n < self.dlc[0] or n > self.dlc[1]):
+            return False
+
+        if self.rtr is not None and msg.rtr != self.rtr:
+            return False
+
+        if self.ext is not None and msg.ext != self.ext:
+            return False
+
+        for i, mask, value in self.masks:
+            if n <= i or d[i] & mask != value:
+                return False
+
+        for q in self.others:
+            if not q.matches(msg):
+                return False
+
+        return True
+
+    def opcodes(self) -> tuple | None:
+        # frames with no opcode cannot be routed by opcode
+        if self.table is not None:
+            return None if self.empty else tuple(op for op in range(256) if self.table[op])
+
+        for q in self.others:
+            ops = q.opcodes()
+            if ops is not None:
+                return ops
+
+        return None
+
+    def is_table_only(self) -> bool:
+        return (self.table is not None and self.nn is None and self.en is None and self.canid is None
+                and self.dlc is None and self.rtr is None and self.ext is None and not self.masks and not self.others)
+
+
+class disjunction:
+    def __init__(self, queries: tuple) -> None:
+        self.queries = queries
+
+    def matches(self, msg: canmessage.canmessage) -> bool:
+        for q in self.queries:
+            if q.matches(msg):
+                return True
+        return False
+
+    def opcodes(self) -> tuple | None:
+        ops = set()
+
+        for q in self.queries:
+            qops = q.opcodes()
+            if qops is None:
+                return None
+            ops.update(qops)
+
+        return tuple(ops)
+
+
+class negation:
+    def __init__(self, query) -> None:
+        self.query = query
+
+    def matches(self, msg: canmessage.canmessage) -> bool:
+        return not self.query.matches(msg)
+
+    def opcodes(self) -> tuple | None:
+        return None
+
+
+def opcode_table(test) -> bytearray:
+    return bytearray(1 if test(op) else 0 for op in range(256))
+
+
+# opcode tests
+
+def opcodes(*ops) -> conjunction:
+    ops = set(ops)
+    return conjunction(table=opcode_table(lambda op: op in ops))
+
+
+def events() -> conjunction:
+    return conjunction(table=opcode_table(lambda op: canmessage.opcode_classes[op] & canmessage.OPC_CLASS_EVENT))
+
+
+def short_events() -> conjunction:
+    mask = canmessage.OPC_CLASS_EVENT | canmessage.OPC_CLASS_SHORT
+    return conjunction(table=opcode_table(lambda op: canmessage.opcode_classes[op] & mask == mask))
+
+
+def long_events() -> conjunction:
+    mask = canmessage.OPC_CLASS_EVENT | canmessage.OPC_CLASS_SHORT
+    return conjunction(table=opcode_table(lambda op: canmessage.opcode_classes[op] & mask == canmessage.OPC_CLASS_EVENT))
+
+
+def polarity(pol: int) -> conjunction:
+    # events of one polarity, or either
+    if pol == canmessage.POLARITY_EITHER:
+        return events()
+
+    off = canmessage.OPC_CLASS_OFF if pol == canmessage.POLARITY_OFF else 0
+    mask = canmessage.OPC_CLASS_EVENT | canmessage.OPC_CLASS_OFF
+    return conjunction(table=opcode_table(lambda op: canmessage.opcode_classes[op] & mask == canmessage.OPC_CLASS_EVENT | off))
+
+
+def long_messages() -> conjunction:
+    return conjunction(table=opcode_table(lambda op: canmessage.opcode_classes[op] & canmessage.OPC_CLASS_LONG_MESSAGE))
+
+
+# field tests, a single value or an inclusive range
+
+def nn(lo: int, hi: int = None) -> conjunction:
+    return conjunction(nn=(lo, lo if hi is None else hi))
+
+
+def en(lo: int, hi: int = None) -> conjunction:
+    return conjunction(en=(lo, lo if hi is None else hi))
+
+
+def canid(lo: int, hi: int = None) -> conjunction:
+    return conjunction(canid=(lo, lo if hi is None else hi))
+
+
+def dlc(lo: int, hi: int = None) -> conjunction:
+    return conjunction(dlc=(lo, lo if hi is None else hi))
+
+
+def rtr(state: bool = True) -> conjunction:
+    return conjunction(rtr=state)
+
+
+def ext(state: bool = True) -> conjunction:
+    return conjunction(ext=state)
+
+
+def byte(index: int, mask: int, value: int) -> conjunction:
+    # data[index] & mask == value
+    return conjunction(masks=((index, mask, value & mask),))
+
+
+def event(pol: int, node: int, evnum: int) -> conjunction:
+    return all_of(polarity(pol), nn(node), en(evnum))
+
+
+# combinations
+
+def intersect(r1: tuple, r2: tuple) -> tuple:
+    # an empty intersection is kept as a range that nothing is in
+    if r1 is None:
+        return r2
+    if r2 is None:
+        return r1
+    return max(r1[0], r2[0]), min(r1[1], r2[1])
+
+
+def all_of(*queries):
+    # opcode tables and ranges are intersected, masks concatenated, nested conjunctions are flattened
+    c = conjunction()
+    masks = []
+    others = []
+
+    for q in queries:
+        if isinstance(q, conjunction):
+            if q.table is not None:
+                if c.table is None:
+                    c.table = bytearray(q.table)
+                    c.empty = q.empty
+                else:
+                    c.table = bytearray(a & b for a, b in zip(c.table, q.table))
+                    c.empty = c.empty and q.empty
+            c.nn = intersect(c.nn, q.nn)
+            c.en = intersect(c.en, q.en)
+            c.canid = intersect(c.canid, q.canid)
+            c.dlc = intersect(c.dlc, q.dlc)
+            # conflicting flags can match nothing
+            if q.rtr is not None:
+                if c.rtr is not None and c.rtr != q.rtr:
+                    c.table = bytearray(256)
+                c.rtr = q.rtr
+            if q.ext is not None:
+                if c.ext is not None and c.ext != q.ext:
+                    c.table = bytearray(256)
+                c.ext = q.ext
+            masks.extend(q.masks)
+            others.extend(q.others)
+        else:
+            others.append(q)
+
+    c.masks = tuple(masks)
+    c.others = tuple(others)
+    return c
+
+
+def any_of(*queries):
+    # opcode-only queries are merged into one table, nested disjunctions are flattened
+    table = None
+    empty = False
+    rest = []
+
+    for q in queries:
+        if isinstance(q, disjunction):
+            rest.extend(q.queries)
+        elif isinstance(q, conjunction) and q.is_table_only():
+            table = bytearray(q.table) if table is None else bytearray(a | b for a, b in zip(table, q.table))
+            empty = empty or q.empty
+        else:
+            rest.append(q)
+
+    if table is not None:
+        rest.insert(0, conjunction(table=table, empty=empty))
+
+    return rest[0] if len(rest) == 1 else disjunction(tuple(rest))
+
+
+def negate(query):
+    # a frame with no data fails every opcode test, so passes its negation
+    if isinstance(query, conjunction) and query.is_table_only():
+        return conjunction(table=bytearray(0 if x else 1 for x in query.table), empty=not query.empty)
+    elif isinstance(query, negation):
+        return query.query
+
+    return negation(query)
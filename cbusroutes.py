@@ -64,12 +64,20 @@ class route:
         self.occupied = False
         self.occupied_evt = None
         self.occupancy_states = []
+        self.occupancy_index = {}
         self.occupancy_task_handle = None
 
         if self.occupancy_events:
             if len(self.occupancy_events) > 0:
+                # event key -> (occupancy sensor, occupied), the first listed sensor wins
+                for i, e in enumerate(self.occupancy_events):
+                    for state in (False, True):
+                        key = canmessage.event_key_from_tuple(e[state])
+                        if key not in self.occupancy_index:
+                            self.occupancy_index[key] = (i, state)
+
                 self.occupancy_states = [False] * len(self.occupancy_events)
-                self.occupancy_sub = cbuspubsub.subscription('route:' + self.name + ':occ:sub', self.cbus, query_type=canmessage.QUERY_UDF, query=self.occ_sub_udf)
+                self.occupancy_sub = cbuspubsub.subscription('route:' + self.name + ':occ:sub', self.cbus, query_type=canmessage.QUERY_UDF, query=self.occ_sub_udf, overflow=cbuspubsub.OVERFLOW_COALESCE)
                 self.occupancy_task_handle = asyncio.create_task(self.occupancy_task())
 
         self.lock = asyncio.Lock()
@@ -87,26 +95,16 @@ class route:
         return self.state
 
     def occ_sub_udf(self, msg) -> bool:
-        ev = tuple(msg)
-        for ov in self.occupancy_events:
-            if ev in ov:
-                return True
-        return False
+        return msg.event_key() in self.occupancy_index
 
     async def occupancy_task(self) -> None:
         last_state = False
 
         while True:
             msg = await self.occupancy_sub.wait()
-            t = tuple(msg)
 
-            for i, e in enumerate(self.occupancy_events):
-                if t == e[0]:
-                    self.occupancy_states[i] = False
-                    break
-                if t == e[1]:
-                    self.occupancy_states[i] = True
-                    break
+            if x := self.occupancy_index.get(msg.event_key()):
+                self.occupancy_states[x[0]] = x[1]
 
             self.occupied = True in self.occupancy_states
 
@@ -7,6 +7,7 @@ import canmessage
 import cbus
 import cbushistory
 import cbusobjects
+import cbuspattern
 import cbuspubsub
 import logger
 
@@ -61,14 +62,18 @@ SEQUENCE_COMPLETE_EVENT = const(1)
 SEQUENCE_TIMEOUT_EVENT = const(2)
 SEQUENCE_CANCELLED_EVENT = const(3)
 
+# default time allowed from the first to the last event of a STEP_HISTORY_SEQUENCE_WAITFOR step, in ms
+SEQUENCE_WINDOW = const(5_000)
+
 
 class step:
 
-    def __init__(self, object, type, data, target_state):
+    def __init__(self, object, type, data, target_state, window: int = SEQUENCE_WINDOW):
         self.object = object
         self.type = type
         self.data = data
         self.target_state = target_state
+        self.window = window
 
 
 class sequence:
@@ -86,7 +91,7 @@ class sequence:
         self.evt = asyncio.Event()
         self.evt.clear()
         self.sub = None
-        self.history = None
+        self.pattern = None
         self.wait_timeout = 30_000
         self.timed_out = False
 
@@ -199,7 +204,7 @@ class sequence:
 
                 elif self.current_step.type == STEP_TIME_WAITUNTIL:
                     self.logger.log(f'time wait until {self.current_step.target_state}')
-                    while time.ticks_ms() != self.current_step.target_state:
+                    while time.ticks_diff(self.current_step.target_state, time.ticks_ms()) > 0:
                         await asyncio.sleep_ms(500)
 
                 elif self.current_step.type == STEP_CLOCK_WAITUNTIL:
@@ -218,17 +223,14 @@ class sequence:
 
                 elif self.current_step.type == STEP_HISTORY_SEQUENCE_WAITFOR:
                     self.logger.log(f'wait for sequence {self.current_step.data}')
-                    self.history = cbushistory.cbushistory(self.cbus, -1, 5_000, canmessage.QUERY_TUPLES, tuple(self.current_step.data))
-                    while True:
-                        x = await cbusobjects.WaitAnyTimeout((self.history,), self.wait_timeout).wait()
-                        if not x:
-                            self.timed_out = True
-                            self.logger.log('timed out')
-                            break
-                        if self.history.sequence_received(self.current_step.data, order=cbushistory.ORDER_GIVEN, which=cbushistory.WHICH_LATEST):
-                            self.history.remove()
-                            self.history = None
-                            break
+                    self.pattern = cbuspattern.pattern(f'{self.name}:{self.current_index}', self.cbus, tuple(self.current_step.data),
+                                                       order=cbushistory.ORDER_GIVEN, window=self.current_step.window)
+                    x = await cbusobjects.WaitAnyTimeout((self.pattern,), self.wait_timeout).wait()
+                    self.pattern.remove()
+                    self.pattern = None
+                    if not x:
+                        self.timed_out = True
+                        self.logger.log('timed out')
 
                 elif self.current_step.type == STEP_SEND_EVENT:
                     self.logger.log('send event')
@@ -276,10 +276,11 @@ class cbusservo:
     async def listener(self) -> None:
         self.sub = cbuspubsub.subscription('servo:' + self.name + ':listener', self.cbus, canmessage.QUERY_TUPLES,
                                            self.consumer_events)
+        close_key = canmessage.event_key_from_tuple(self.consumer_events[0])
         try:
             while True:
                 msg = await self.sub.wait()
-                if tuple(msg) == self.consumer_events[0]:
+                if msg.event_key() == close_key:
                     await self.close()
                 else:
                     await self.open()
@@ -0,0 +1,49 @@
+# cbustime.py
+# timestamps and wrap-safe time comparisons
+
+# ticks_ms() and ticks_us() wrap, so two times can only be compared through ticks_diff(), and only while they
+# are less than half the ticks period apart (about six days for ms, nine minutes for us on the RP2040)
+# times kept for longer than a few seconds are in ms, and the us time of a received frame is only used close
+# to when it arrived
+
+import time
+
+
+def now() -> int:
+    return time.ticks_ms()
+
+
+def now_us() -> int:
+    return time.ticks_us()
+
+
+def elapsed(t: int, tnow: int = None) -> int:
+    # ms since t
+    return time.ticks_diff(time.ticks_ms() if tnow is None else tnow, t)
+
+
+def elapsed_us(t: int, tnow: int = None) -> int:
+    return time.ticks_diff(time.ticks_us() if tnow is None else tnow, t)
+
+
+def is_within(t: int, ms: int, tnow: int = None) -> bool:
+    # t is less than ms ago
+    return elapsed(t, tnow) < ms
+
+
+def has_expired(t: int, ttl: int, tnow: int = None) -> bool:
+    return elapsed(t, tnow) > ttl
+
+
+def is_before(t1: int, t2: int) -> bool:
+    return time.ticks_diff(t1, t2) < 0
+
+
+def span(t1: int, t2: int) -> int:
+    # ms from t1 to t2, negative if t2 is before t1
+    return time.ticks_diff(t2, t1)
+
+
+def to_ms(t_us: int) -> int:
+    # the ticks_ms() time of a ticks_us() timestamp taken in the last few minutes
+    return time.ticks_add(time.ticks_ms(), -(elapsed_us(t_us) // 1000))
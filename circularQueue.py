@@ -24,10 +24,11 @@ class circularQueue:
         self.lock.release()
         return size > 0
 
-    async def enqueue(self, item: canmessage.canmessage) -> None:
+    async def enqueue(self, item: canmessage.canmessage) -> bool:
         if self.size == self.capacity:
             self.dropped = self.dropped + 1
             print('queue is full')
+            return False
         else:
             await self.lock.acquire()
             self.tail = (self.tail + 1) % self.capacity
@@ -37,6 +38,7 @@ class circularQueue:
             self.puts += 1
             self.lock.release()
             # print('enqueued new message')
+            return True
 
     async def dequeue(self) -> canmessage.canmessage | None:
         if self.size == 0:
@@ -53,11 +55,50 @@ class circularQueue:
             # print('item dequeued')
             return tmp
 
-    # def peek(self):
-    #     if self.size == 0:
-    #         return None
-    #     else:
-    #         return self.queue[self.head]
+    def full(self) -> bool:
+        return self.size == self.capacity
+
+    def put_nowait(self, item) -> bool:
+        # for callers that cannot await, returns False if the queue is full
+        if self.size == self.capacity:
+            self.dropped += 1
+            return False
+
+        self.tail = (self.tail + 1) % self.capacity
+        self.queue[self.tail] = item
+        self.size += 1
+        self.hwm = self.size if self.size > self.hwm else self.hwm
+        self.puts += 1
+        return True
+
+    def get_nowait(self):
+        if self.size == 0:
+            return None
+
+        tmp = self.queue[self.head]
+        self.queue[self.head] = None
+        self.head = (self.head + 1) % self.capacity
+        self.size -= 1
+        self.gets += 1
+        return tmp
+
+    def peek(self):
+        if self.size == 0:
+            return None
+        else:
+            return self.queue[self.head]
+
+    def drop_newest(self):
+        # take back the last item put, counted as dropped
+        if self.size == 0:
+            return None
+
+        tmp = self.queue[self.tail]
+        self.queue[self.tail] = None
+        self.tail = (self.tail - 1) % self.capacity
+        self.size -= 1
+        self.dropped += 1
+        return tmp
 
     # def empty(self):
     #     self.tail = -1
@@ -72,3 +113,101 @@ class circularQueue:
     #     for i in range(self.size):
     #         print(self.queue[index])
     #         index = (index + 1) % self.capacity
+
+
+class priorityQueue:
+    # one circularQueue per class of item, with the interface of a circularQueue
+    # class 0 is always served first, and the other classes take turns, each taking up to its weight of
+    # items per turn, so none waits behind a burst in another for more than the sum of the weights
+    # items of the same class stay in order
+    # capacity is shared by all the classes, so the queue never holds more than capacity items, and when it is
+    # full a class 0 item displaces the newest item of the lowest class that has any
+
+    def __init__(self, capacity: int, classify, weights: tuple) -> None:
+        self.capacity = capacity
+        self.classify = classify
+        self.weights = weights
+        self.queues = [circularQueue(capacity) for _ in weights]
+        self.current = 1 if len(weights) > 1 else 0
+        self.credit = weights[self.current]
+        self.size = 0
+
+    async def available(self) -> bool:
+        return self.size > 0
+
+    async def enqueue(self, item: canmessage.canmessage) -> bool:
+        return self.put_nowait(item)
+
+    async def dequeue(self) -> canmessage.canmessage | None:
+        return self.get_nowait()
+
+    def full(self) -> bool:
+        return self.size >= self.capacity
+
+    def put_nowait(self, item) -> bool:
+        cls = self.classify(item)
+        q = self.queues[cls]
+
+        if self.size >= self.capacity:
+            if cls != 0:
+                q.dropped += 1
+                return False
+
+            for low in range(len(self.queues) - 1, 0, -1):
+                if self.queues[low].size > 0:
+                    self.queues[low].drop_newest().release()
+                    self.size -= 1
+                    break
+            else:
+                q.dropped += 1
+                return False
+
+        if q.put_nowait(item):
+            self.size += 1
+            return True
+
+        return False
+
+    def next_class(self) -> int:
+        # the class the next item will come from, without taking it
+        if self.queues[0].size > 0:
+            return 0
+
+        current = self.current
+        credit = self.credit
+
+        for _ in range(2 * len(self.queues)):
+            if credit > 0 and self.queues[current].size > 0:
+                return current
+
+            current = current + 1 if current + 1 < len(self.queues) else 1
+            credit = self.weights[current]
+
+        return 0
+
+    def charge(self, cls: int) -> None:
+        # an item has been taken from cls, so spend one of its turn
+        if cls == 0:
+            return
+
+        if cls != self.current:
+            self.current = cls
+            self.credit = self.weights[cls]
+
+        self.credit -= 1
+
+    def get_nowait(self):
+        if self.size == 0:
+            return None
+
+        cls = self.next_class()
+        self.charge(cls)
+        self.size -= 1
+        return self.queues[cls].get_nowait()
+
+    def peek(self):
+        return self.queues[self.next_class()].peek() if self.size > 0 else None
+
+    def stats(self) -> list:
+        # (puts, gets, dropped, high-water mark) for each class
+        return [(q.puts, q.gets, q.dropped, q.hwm) for q in self.queues]
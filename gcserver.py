@@ -90,6 +90,7 @@ class gcserver:
                 msg = await self.output_queue.get()
                 # await self.send_message(msg)
                 gc = self.CANtoGC(msg)
+                msg.release()
                 count = 0
 
                 for idx in range(len(self.clients)):
@@ -134,17 +135,7 @@ class gcserver:
                 self.logger.log(f'[{i} {c.get_extra_info("peername")}')
 
     def CANtoGC(self, msg: canmessage.canmessage) -> str:
-        tid = msg.canid << 5
-
-        gc = ':'
-        gc += f'X{tid:04X}' if msg.ext else f'S{tid:04X}'
-        gc += 'R' if msg.rtr else 'N'
-
-        for i in range(msg.dlc):
-            gc += f'{msg.data[i]:02X}'
-
-        gc += ';'
-        return gc
+        return msg.gridconnect()
 
     def GCtoCAN(self, gc: str) -> canmessage.canmessage | None:
         # self.logger.log(f'** GCtoCAN {gc}')
@@ -6,12 +6,26 @@
 import time
 
 from machine import Pin, I2C
+from micropython import const
 
 import logger
 
+# size, page size and address bytes of common parts
+# 1-byte address parts larger than 256 bytes take the upper address bits in the device address
+PART_24C02 = (256, 8, 1)
+PART_24C04 = (512, 16, 1)
+PART_24C16 = (2048, 16, 1)
+PART_24LC32 = (4096, 32, 2)
+PART_24LC64 = (8192, 32, 2)
+PART_24LC128 = (16384, 64, 2)
+PART_24LC256 = (32768, 64, 2)
+PART_24LC512 = (65536, 128, 2)
+
+WRITE_TIMEOUT = const(20)
+
 
 class i2ceeprom:
-    def __init__(self, i2caddr=0x50, scl_pin=17, sda_pin=16, size=8192):
+    def __init__(self, i2caddr=0x50, scl_pin=17, sda_pin=16, size=8192, page_size=32, addr_size=2, part=None):
         self.logger = logger.logger()
         self.logger.log("** i2ceeprom constructor")
 
@@ -21,30 +35,92 @@ class i2ceeprom:
         slaves = self.bus.scan()
         self.logger.log(f"found devices: {slaves}")
 
-        self._addrbuf = bytearray(2)
+        if part is not None:
+            size, page_size, addr_size = part
+
+        self._addrbuf = bytearray(addr_size)
         self._databuf = bytearray(1)
         self.set_size(size)
+        self.page_size = page_size
+        self.addr_size = addr_size
+
+        # a write cycle may still be in progress after a soft reset
+        self.write_pending = True
+        self.num_polls = 0
 
     def set_size(self, size):
         self.size = size
 
+    def set_address(self, addr) -> int:
+        # fill the address buffer and return the device address to use
+        if self.addr_size == 2:
+            self._addrbuf[0] = (addr >> 8) & 0xff
+            self._addrbuf[1] = addr & 0xff
+            return self.i2caddr
+        else:
+            self._addrbuf[0] = addr & 0xff
+            return self.i2caddr | ((addr >> 8) & 0x07)
+
+    def wait_ready(self):
+        # the device does not acknowledge its address until an internal write cycle is complete
+        # so poll it rather than wait for the worst case write time
+        if not self.write_pending:
+            return
+
+        start = time.ticks_ms()
+
+        while True:
+            try:
+                self.bus.writeto(self.i2caddr, b'')
+                break
+            except OSError:
+                self.num_polls += 1
+                if time.ticks_diff(time.ticks_ms(), start) > WRITE_TIMEOUT:
+                    self.write_pending = False
+                    raise OSError('i2ceeprom: device did not complete write')
+
+        self.write_pending = False
+
     def read(self, addr):
-        self._addrbuf[0] = (addr >> 8) & 0xff
-        self._addrbuf[1] = addr & 0xff
+        self.read_into(addr, self._databuf)
+        return bytes(self._databuf)
+
+    def read_into(self, addr, buf):
+        # one sequential read of len(buf) bytes
+        # 1-byte address parts cannot read across a device address block
+        self.wait_ready()
+        mv = memoryview(buf)
+        pos = 0
 
-        self.bus.writeto(self.i2caddr, self._addrbuf)
-        data = self.bus.readfrom(self.i2caddr, 1)
-        return data
+        while pos < len(mv):
+            n = len(mv) - pos if self.addr_size == 2 else min(len(mv) - pos, 256 - ((addr + pos) & 0xff))
+            dev = self.set_address(addr + pos)
+            self.bus.writeto(dev, self._addrbuf, False)
+            self.bus.readfrom_into(dev, mv[pos: pos + n])
+            pos += n
 
     def write(self, addr, data):
-        t = bytearray(3)
-        t[0] = (addr >> 8) & 0xff
-        t[1] = addr & 0xff
-        t[2] = data & 0xff
+        self._databuf[0] = data & 0xff
+        self.write_block(addr, self._databuf)
 
-        self.bus.writeto(self.i2caddr, t)
-        time.sleep_ms(5)
+    def write_block(self, addr, data):
+        # one write transaction per page, a write must not cross a page boundary
+        # returns once the last page has been sent; its write cycle is waited for by the next access
+        mv = memoryview(data)
+        pos = 0
+
+        while pos < len(mv):
+            n = min(self.page_size - ((addr + pos) % self.page_size), len(mv) - pos)
+            self.wait_ready()
+            dev = self.set_address(addr + pos)
+            self.bus.writevto(dev, (self._addrbuf, mv[pos: pos + n]))
+            self.write_pending = True
+            pos += n
 
     def erase(self):
-        for x in range(0, self.size - 1):
-            self.write(x, 0xff)
+        blank = bytearray([0xff] * self.page_size)
+
+        for x in range(0, self.size, self.page_size):
+            self.write_block(x, blank)
+
+        self.wait_ready()
@@ -52,6 +52,7 @@ class ERROR:
     ERROR_FAILINIT = const(3)
     ERROR_FAILTX = const(4)
     ERROR_NOMSG = const(5)
+    ERROR_FILTERED = const(6)
 
 
 class MASK:
@@ -148,10 +149,17 @@ MCP_DATA = const(5)
 class STAT:
     STAT_RX0IF = const(1 << 0)
     STAT_RX1IF = const(1 << 1)
+    STAT_TX0REQ = const(1 << 2)
+    STAT_TX1REQ = const(1 << 4)
+    STAT_TX2REQ = const(1 << 6)
 
 
 STAT_RXIF_MASK = STAT.STAT_RX0IF | STAT.STAT_RX1IF
 
+CANINTF_RXIF_MASK = CANINTF.CANINTF_RX0IF | CANINTF.CANINTF_RX1IF
+CANINTF_TXIF_MASK = CANINTF.CANINTF_TX0IF | CANINTF.CANINTF_TX1IF | CANINTF.CANINTF_TX2IF
+TXB_CANINTF = (CANINTF.CANINTF_TX0IF, CANINTF.CANINTF_TX1IF, CANINTF.CANINTF_TX2IF)
+
 
 class TXBnCTRL:
     TXB_ABTF = const(0x40)
@@ -271,6 +279,14 @@ class REGISTER:
 
 N_TXBUFFERS = const(3)
 N_RXBUFFERS = const(2)
+N_FILTERS = const(6)
+
+# the filters of RXB0 that select standard frames by opcode, RXB1 takes extended frames
+N_OPCODE_FILTERS = const(2)
+
+# ms a frame may wait in a transmit buffer before it is aborted, as the device retries a frame that loses
+# arbitration or has an error for as long as it takes, and holds it while the bus is off
+TX_TIMEOUT = const(1_000)
 
 # CAN_CFGS = {
 #     CAN_CLOCK.MCP_8MHZ: {
@@ -308,6 +324,14 @@ SPI_DUMMY_INT = const(0x00)
 SPI_TRANSFER_LEN = const(1)
 SPI_HOLD_US = const(50)
 
+# instruction + address + CTRL + SIDH..DLC + 8 data bytes
+SPI_BUFFER_LEN = const(16)
+
+# RXBnCTRL, RXBnSIDH..RXBnDLC and RXBnD0..RXBnD7, and their offsets in the SPI receive buffer
+RXB_BLOCK_LEN = const(14)
+RXB_CTRL_OFFSET = const(2)
+RXB_HEADER_OFFSET = const(3)
+
 # SPI_DEFAULT_BAUDRATE = 10000000  # 10MHz
 # SPI_DEFAULT_FIRSTBIT = SPI.MSB
 # SPI_DEFAULT_POLARITY = 0
@@ -333,13 +357,22 @@ CAN_ERR_MASK = const(0x1FFFFFFF)  # omit EFF, RTR, ERR flags
 # CAN ID length
 CAN_IDLEN = const(4)
 
-TXBnREGS = namedtuple("TXBnREGS", "CTRL SIDH DATA")
-RXBnREGS = namedtuple("RXBnREGS", "CTRL SIDH DATA CANINTFRXnIF")
+# RXBnSIDH..RXBnDLC and RXBnD0..RXBnD7, as returned by the READ RX BUFFER instruction
+RXB_FRAME_LEN = const(13)
+
+# standard frame remote request bit in RXBnSIDL
+RXBnSIDL_SRR = const(0x10)
+
+TXBnREGS = namedtuple("TXBnREGS", "CTRL SIDH DATA LOAD RTS STATTXREQ")
+RXBnREGS = namedtuple("RXBnREGS", "CTRL SIDH DATA CANINTFRXnIF READ")
 
 TXB = [
-    TXBnREGS(REGISTER.MCP_TXB0CTRL, REGISTER.MCP_TXB0SIDH, REGISTER.MCP_TXB0DATA),
-    TXBnREGS(REGISTER.MCP_TXB1CTRL, REGISTER.MCP_TXB1SIDH, REGISTER.MCP_TXB1DATA),
-    TXBnREGS(REGISTER.MCP_TXB2CTRL, REGISTER.MCP_TXB2SIDH, REGISTER.MCP_TXB2DATA),
+    TXBnREGS(REGISTER.MCP_TXB0CTRL, REGISTER.MCP_TXB0SIDH, REGISTER.MCP_TXB0DATA,
+             INSTRUCTION.INSTRUCTION_LOAD_TX0, INSTRUCTION.INSTRUCTION_RTS_TX0, STAT.STAT_TX0REQ),
+    TXBnREGS(REGISTER.MCP_TXB1CTRL, REGISTER.MCP_TXB1SIDH, REGISTER.MCP_TXB1DATA,
+             INSTRUCTION.INSTRUCTION_LOAD_TX1, INSTRUCTION.INSTRUCTION_RTS_TX1, STAT.STAT_TX1REQ),
+    TXBnREGS(REGISTER.MCP_TXB2CTRL, REGISTER.MCP_TXB2SIDH, REGISTER.MCP_TXB2DATA,
+             INSTRUCTION.INSTRUCTION_LOAD_TX2, INSTRUCTION.INSTRUCTION_RTS_TX2, STAT.STAT_TX2REQ),
 ]
 
 RXB = [
@@ -348,31 +381,98 @@ RXB = [
         REGISTER.MCP_RXB0SIDH,
         REGISTER.MCP_RXB0DATA,
         CANINTF.CANINTF_RX0IF,
+        INSTRUCTION.INSTRUCTION_READ_RX0,
     ),
     RXBnREGS(
         REGISTER.MCP_RXB1CTRL,
         REGISTER.MCP_RXB1SIDH,
         REGISTER.MCP_RXB1DATA,
         CANINTF.CANINTF_RX1IF,
+        INSTRUCTION.INSTRUCTION_READ_RX1,
     ),
 ]
 
 
+def frame_canid(tbufdata) -> int:
+    # the CBUS CAN ID, the low 7 bits of a standard frame's identifier, from SIDH and SIDL
+    return ((tbufdata[MCP_SIDH] & 0x0f) << 3) | (tbufdata[MCP_SIDL] >> 5)
+
+
+def opcode_filter_cover(opcodes, max_values: int = N_OPCODE_FILTERS) -> tuple:
+    # find a single mask over the opcode byte, and at most max_values filter values, which together accept
+    # every opcode in opcodes while admitting as few other opcodes as possible
+    # the software pre-filter removes the extra opcodes that the hardware lets through
+
+    if not opcodes:
+        return 0xff, (0,)
+
+    best_mask = 0
+    best_values = (0,)
+    best_cost = 256
+
+    for mask in range(1, 256):
+        values = []
+
+        for op in opcodes:
+            v = op & mask
+            if v not in values:
+                values.append(v)
+                if len(values) > max_values:
+                    break
+
+        if len(values) > max_values:
+            continue
+
+        cost = len(values) << (8 - bin(mask).count('1'))
+
+        if cost < best_cost:
+            best_mask = mask
+            best_values = tuple(values)
+            best_cost = cost
+
+    return best_mask, best_values
+
+
+class txrequest:
+    # a sender waiting for its frame to be transmitted, and the outcome
+    def __init__(self) -> None:
+        self.evt = asyncio.Event()
+        self.result = ERROR.ERROR_OK
+
+
 class mcp2515(canio.canio):
     """a canio derived class for use with an MCP2515 CAN controller device"""
 
-    def __init__(self, osc: int = 16_000_000, cs_pin: int = 5, interrupt_pin: int = 1, bus=None, rxq_size: int = 16, txq_size: int = 4):
+    def __init__(self, osc: int = 16_000_000, cs_pin: int = 5, interrupt_pin: int = 1, bus=None, rxq_size: int = 16, txq_size: int = 4, fast_io: bool = False,
+                 pool_size: int = None, pool_debug: bool = False, rx_priority: bool = True, tx_timeout: int = TX_TIMEOUT):
         super().__init__()
         self.logger = logger.logger()
         self.poll = False
 
+        # use the READ RX BUFFER and LOAD TX BUFFER instructions to move frames
+        self.fast_io = fast_io
+
         # crystal frequency
         self.osc = osc
 
         # message buffers
-        self.rx_queue = circularQueue.circularQueue(rxq_size)
+        # received frames are queued by class, so emergency and enumeration frames are not held up by a burst
+        # of events or bulk traffic, see canmessage.receive_class
+        if rx_priority:
+            self.rx_queue = circularQueue.priorityQueue(rxq_size, canmessage.receive_class, canmessage.RX_CLASS_WEIGHTS)
+        else:
+            self.rx_queue = circularQueue.circularQueue(rxq_size)
         self.tx_queue = circularQueue.circularQueue(txq_size)
 
+        # received frames come from a pool big enough for a full receive queue plus the frame being
+        # dispatched, a pool_size of 0 allocates a new message per frame
+        # the classes of the priority queue share its capacity, so this is rxq_size in either case
+        if pool_size is None:
+            pool_size = self.rx_queue.capacity + 2
+
+        if pool_size > 0:
+            self.pool = canmessage.messagepool(pool_size, pool_debug)
+
         # init chip select and interrupt pins
         self.cs_pin = Pin(cs_pin, Pin.OUT)
         self.cs_pin.high()
@@ -396,8 +496,31 @@ class mcp2515(canio.canio):
         else:
             self.bus = bus
 
+        # preallocated buffers for burst register I/O
+        # one transaction moves an instruction, an address and a whole register block
+        self.spi_txbuf = bytearray(SPI_BUFFER_LEN)
+        self.spi_rxbuf = bytearray(SPI_BUFFER_LEN)
+        self.spi_txmv = memoryview(self.spi_txbuf)
+        self.spi_rxmv = memoryview(self.spi_rxbuf)
+        self.num_spi_transactions = 0
+
+        # hardware acceptance mask and filter values applied to the opcode byte
+        self.filter_mask = 0
+        self.filter_values = (0,)
+        self.started = False
+
         self.mcp2515_rx_index = 0
-        self.txb_free = [True] * 3
+
+        # transmit buffer state, maintained by the TX complete and error interrupt handlers and the TX watchdog
+        self.txb_free = [True] * N_TXBUFFERS
+        self.txb_prio = [0] * N_TXBUFFERS
+        self.txb_req = [None] * N_TXBUFFERS
+        self.txb_time = [0] * N_TXBUFFERS
+        self.tx_space_evt = asyncio.Event()
+        self.tx_timeout = tx_timeout
+        self.num_tx_complete = 0
+        self.num_tx_failed = 0
+        self.num_rx_overflows = 0
         self.tsf = asyncio.ThreadSafeFlag()
         self.message_received_flag = None
 
@@ -408,6 +531,7 @@ class mcp2515(canio.canio):
         output int value are unsigned.
         """
         value_as_byte = value.to_bytes(SPI_TRANSFER_LEN, sys.byteorder)
+        self.num_spi_transactions += 1
 
         if read:
             output = bytearray(SPI_TRANSFER_LEN)
@@ -416,6 +540,26 @@ class mcp2515(canio.canio):
         self.bus.write(value_as_byte)
         return None
 
+    def spi_write(self, n: int) -> None:
+        """Write the first n bytes of the transmit buffer to the device as a single,
+        chip-selected SPI transaction.
+        """
+        self.cs_pin.low()
+        self.bus.write(self.spi_txmv[:n])
+        self.cs_pin.high()
+        self.num_spi_transactions += 1
+
+    def spi_write_readinto(self, n: int) -> None:
+        """Clock the first n bytes of the transmit buffer out to the device and
+        read the same number of bytes into the receive buffer, as a single,
+        chip-selected SPI transaction. Response bytes follow the instruction and
+        address bytes in the receive buffer.
+        """
+        self.cs_pin.low()
+        self.bus.write_readinto(self.spi_txmv[:n], self.spi_rxmv[:n])
+        self.cs_pin.high()
+        self.num_spi_transactions += 1
+
     def begin(self) -> int:
         self.reset()
 
@@ -455,8 +599,8 @@ class mcp2515(canio.canio):
         # self.set_register(REGISTER.MCP_CANINTE,
         #                  CANINTF.CANINTF_RX0IF | CANINTF.CANINTF_RX1IF | CANINTF.CANINTF_TX0IF | CANINTF.CANINTF_TX1IF | CANINTF.CANINTF_TX2IF)
 
-        # enable message receive interrupts
-        self.set_register(REGISTER.MCP_CANINTE, CANINTF.CANINTF_RX0IF | CANINTF.CANINTF_RX1IF)
+        # enable message receive, transmit complete and error interrupts
+        self.set_register(REGISTER.MCP_CANINTE, CANINTF_RXIF_MASK | CANINTF_TXIF_MASK | CANINTF.CANINTF_ERRIF)
 
         # self.set_register(REGISTER.MCP_CANINTE, CANINTF.CANINTF_RX0IF | CANINTF.CANINTF_RX1IF |
         #                   CANINTF.CANINTF_TX0IF | CANINTF.CANINTF_TX1IF | CANINTF.CANINTF_TX2IF)
@@ -474,22 +618,10 @@ class mcp2515(canio.canio):
             RXBnCTRL_RXM_STDEXT | RXB1CTRL_FILHIT,
         )
 
-        # *** not required ***
-
-        # Clear filters and masks
-        # Do not filter any standard frames for RXF0 used by RXB0
-        # Do not filter any extended frames for RXF1 used by RXB1
-        # filters = (RXF.RXF0, RXF.RXF1, RXF.RXF2, RXF.RXF3, RXF.RXF4, RXF.RXF5)
-        # for f in filters:
-        #     ext = True if f == RXF.RXF1 else False
-        #     result = self.set_filter(f, ext, 0)
-        #     if result != ERROR.ERROR_OK:
-        #         return result
-        # masks = (MASK.MASK0, MASK.MASK1)
-        # for m in masks:
-        #     result = self.set_filter_mask(m, True, 0)
-        #     if result != ERROR.ERROR_OK:
-        #         return result
+        # set masks and filters, which accept all frames unless set_filters has been called
+        result = self.write_filters()
+        if result != ERROR.ERROR_OK:
+            return result
 
         # set bit rate - fixed at 125kb/s, using either 8 or 16 MHz crystal frequency
         self.set_bit_rate()
@@ -499,9 +631,11 @@ class mcp2515(canio.canio):
         # self.interrupt_pin.irq(trigger=Pin.IRQ_FALLING, handler=lambda t: self.poll_for_messages())
         # self.interrupt_pin.irq(trigger=Pin.IRQ_FALLING, handler=lambda t: self.process_interrupts())
         asyncio.create_task(self.process_isr())
+        asyncio.create_task(self.tx_watchdog())
 
         # set normal mode
         self.set_normal_mode()
+        self.started = True
 
         return ERROR.ERROR_OK
 
@@ -510,15 +644,18 @@ class mcp2515(canio.canio):
         while True:
             await self.tsf.wait()
             self.num_interrupts += 1
-            i = self.get_interrupts()
-            # if i & CANINTF.CANINTF_RX0IF:
-            #     await self.poll_for_messages(0)
-            # elif i & CANINTF.CANINTF_RX1IF:
-            #     await self.poll_for_messages(1)
-            # else:
-            #     self.logger.log('** some other interrupt')
 
-            await self.poll_for_messages()
+            # the interrupt pin stays low until every enabled flag is clear, so keep going
+            # until there is nothing left, otherwise the next falling edge is never seen
+            while i := self.get_interrupts() & (CANINTF_RXIF_MASK | CANINTF_TXIF_MASK | CANINTF.CANINTF_ERRIF):
+                if i & CANINTF_TXIF_MASK:
+                    self.process_tx_interrupts(i)
+
+                if i & CANINTF.CANINTF_ERRIF:
+                    self.process_error_interrupt()
+
+                if i & CANINTF_RXIF_MASK:
+                    await self.poll_for_messages()
 
     # def process_interrupts(self):
     #     i = self.get_interrupts()
@@ -552,63 +689,57 @@ class mcp2515(canio.canio):
         return msg
 
     def reset(self):
-        self.cs_pin.low()
-        self.spi_transfer(INSTRUCTION.INSTRUCTION_RESET)
-        self.cs_pin.high()
+        self.spi_txbuf[0] = INSTRUCTION.INSTRUCTION_RESET
+        self.spi_write(1)
         time.sleep_ms(10)
 
     def read_register(self, reg: int) -> int:
-        self.cs_pin.low()
-        self.spi_transfer(INSTRUCTION.INSTRUCTION_READ)
-        self.spi_transfer(reg)
-        ret = self.spi_transfer(read=True)
-        self.cs_pin.high()
-        return ret
+        self.spi_txbuf[0] = INSTRUCTION.INSTRUCTION_READ
+        self.spi_txbuf[1] = reg
+        self.spi_txbuf[2] = SPI_DUMMY_INT
+        self.spi_write_readinto(3)
+        return self.spi_rxbuf[2]
 
-    def read_registers(self, reg: int, n: int) -> list:
-        self.cs_pin.low()
-        self.spi_transfer(INSTRUCTION.INSTRUCTION_READ)
-        self.spi_transfer(reg)
+    def read_registers(self, reg: int, n: int) -> memoryview:
         # MCP2515 has auto-increment of address-pointer
-        values = []
-        for i in range(n):
-            values.append(self.spi_transfer(read=True))
-        self.cs_pin.high()
-        return values
+        # the returned view is only valid until the next SPI transaction
+        self.spi_txbuf[0] = INSTRUCTION.INSTRUCTION_READ
+        self.spi_txbuf[1] = reg
+
+        for i in range(2, n + 2):
+            self.spi_txbuf[i] = SPI_DUMMY_INT
+
+        self.spi_write_readinto(n + 2)
+        return self.spi_rxmv[2:n + 2]
 
     def set_register(self, reg: int, value: int) -> None:
-        self.cs_pin.low()
-        self.spi_transfer(INSTRUCTION.INSTRUCTION_WRITE)
-        self.spi_transfer(reg)
-        self.spi_transfer(value)
-        self.cs_pin.high()
+        self.spi_txbuf[0] = INSTRUCTION.INSTRUCTION_WRITE
+        self.spi_txbuf[1] = reg
+        self.spi_txbuf[2] = value
+        self.spi_write(3)
 
     def set_registers(self, reg: int, values: bytearray) -> None:
-        self.cs_pin.low()
-        self.spi_transfer(INSTRUCTION.INSTRUCTION_WRITE)
-        self.spi_transfer(reg)
-        for v in values:
-            self.spi_transfer(v)
-        self.cs_pin.high()
+        n = len(values)
+        self.spi_txbuf[0] = INSTRUCTION.INSTRUCTION_WRITE
+        self.spi_txbuf[1] = reg
+        self.spi_txbuf[2:n + 2] = values
+        self.spi_write(n + 2)
 
     def modify_register(self, reg: int, mask: int, data: int, spifastend: bool = False) -> None:
-        self.cs_pin.low()
-        self.spi_transfer(INSTRUCTION.INSTRUCTION_BITMOD)
-        self.spi_transfer(reg)
-        self.spi_transfer(mask)
-        self.spi_transfer(data)
-        if not spifastend:
-            self.cs_pin.high()
-        else:
-            self.cs_pin.high()
+        self.spi_txbuf[0] = INSTRUCTION.INSTRUCTION_BITMOD
+        self.spi_txbuf[1] = reg
+        self.spi_txbuf[2] = mask
+        self.spi_txbuf[3] = data
+        self.spi_write(4)
+
+        if spifastend:
             time.sleep_us(SPI_HOLD_US)
 
     def get_status(self) -> int:
-        self.cs_pin.low()
-        self.spi_transfer(INSTRUCTION.INSTRUCTION_READ_STATUS)
-        val = self.spi_transfer(read=True)
-        self.cs_pin.high()
-        return val
+        self.spi_txbuf[0] = INSTRUCTION.INSTRUCTION_READ_STATUS
+        self.spi_txbuf[1] = SPI_DUMMY_INT
+        self.spi_write_readinto(2)
+        return self.spi_rxbuf[1]
 
     def set_config_mode(self) -> int:
         return self.set_mode(CANCTRL_REQOP_MODE.CANCTRL_REQOP_CONFIG)
@@ -689,73 +820,128 @@ class mcp2515(canio.canio):
 
     @staticmethod
     def prepare_id(ext: bool, id_: int) -> bytearray:
-        canid = id_ & 0xffff
         buffer = bytearray(CAN_IDLEN)
+        mcp2515.prepare_id_into(buffer, 0, ext, id_)
+        return buffer
+
+    @staticmethod
+    def prepare_id_into(buffer: bytearray, offset: int, ext: bool, id_: int) -> None:
+        canid = id_ & 0xffff
 
         if ext:
-            buffer[MCP_EID0] = canid & 0xff
-            buffer[MCP_EID8] = canid >> 8
+            buffer[offset + MCP_EID0] = canid & 0xff
+            buffer[offset + MCP_EID8] = canid >> 8
             canid = id_ >> 16
-            buffer[MCP_SIDL] = canid & 0x03
-            buffer[MCP_SIDL] += (canid & 0x1C) << 3
-            buffer[MCP_SIDL] |= TXB_EXIDE_MASK
-            buffer[MCP_SIDH] = canid >> 5
+            sidl = canid & 0x03
+            sidl += (canid & 0x1C) << 3
+            buffer[offset + MCP_SIDL] = sidl | TXB_EXIDE_MASK
+            buffer[offset + MCP_SIDH] = (canid >> 5) & 0xff
+        else:
+            buffer[offset + MCP_SIDH] = (canid >> 3) & 0xff
+            buffer[offset + MCP_SIDL] = (canid & 0x07) << 5
+            buffer[offset + MCP_EID0] = 0
+            buffer[offset + MCP_EID8] = 0
+
+    def set_filter_mask(self, mask: int, ext: bool, ulData: int, data: int = 0) -> int:
+        # the device must be in config mode
+        # for standard frames, the EID8 and EID0 registers apply to the first two data bytes
+
+        if mask == MASK.MASK0:
+            reg = REGISTER.MCP_RXM0SIDH
+        elif mask == MASK.MASK1:
+            reg = REGISTER.MCP_RXM1SIDH
         else:
-            buffer[MCP_SIDH] = canid >> 3
-            buffer[MCP_SIDL] = (canid & 0x07) << 5
-            buffer[MCP_EID0] = 0
-            buffer[MCP_EID8] = 0
+            return ERROR.ERROR_FAIL
 
-        return buffer
+        tbufdata = self.prepare_id(ext, ulData)
 
-    # def set_filter_mask(self, mask: int, ext: int, ulData: int) -> int:
-    #     res = self.set_config_mode()
-    #     if res != ERROR.ERROR_OK:
-    #         return res
-    #
-    #     reg = None
-    #     if mask == MASK.MASK0:
-    #         reg = REGISTER.MCP_RXM0SIDH
-    #     elif mask == MASK.MASK1:
-    #         reg = REGISTER.MCP_RXM1SIDH
-    #     else:
-    #         return ERROR.ERROR_FAIL
-    #
-    #     tbufdata = self.prepare_id(ext, ulData)
-    #     self.set_registers(reg, tbufdata)
-    #
-    #     return ERROR.ERROR_OK
-    #
-    # def set_filter(self, ft: int, ext: int, ulData: int) -> int:
-    #     res = self.set_config_mode()
-    #     if res != ERROR.ERROR_OK:
-    #         return res
-    #
-    #     reg = None
-    #     if ft == RXF.RXF0:
-    #         reg = REGISTER.MCP_RXF0SIDH
-    #     elif ft == RXF.RXF1:
-    #         reg = REGISTER.MCP_RXF1SIDH
-    #     elif ft == RXF.RXF2:
-    #         reg = REGISTER.MCP_RXF2SIDH
-    #     elif ft == RXF.RXF3:
-    #         reg = REGISTER.MCP_RXF3SIDH
-    #     elif ft == RXF.RXF4:
-    #         reg = REGISTER.MCP_RXF4SIDH
-    #     elif ft == RXF.RXF5:
-    #         reg = REGISTER.MCP_RXF5SIDH
-    #     else:
-    #         return ERROR.ERROR_FAIL
-    #
-    #     tbufdata = self.prepare_id(ext, ulData)
-    #     self.set_registers(reg, tbufdata)
-    #
-    #     return ERROR.ERROR_OK
+        if not ext:
+            tbufdata[MCP_EID8] = data >> 8
+            tbufdata[MCP_EID0] = data & 0xff
+
+        self.set_registers(reg, tbufdata)
+        return ERROR.ERROR_OK
+
+    def set_filter(self, ft: int, ext: bool, ulData: int, data: int = 0) -> int:
+        # the device must be in config mode
+        # for standard frames, the EID8 and EID0 registers apply to the first two data bytes
+
+        if ft == RXF.RXF0:
+            reg = REGISTER.MCP_RXF0SIDH
+        elif ft == RXF.RXF1:
+            reg = REGISTER.MCP_RXF1SIDH
+        elif ft == RXF.RXF2:
+            reg = REGISTER.MCP_RXF2SIDH
+        elif ft == RXF.RXF3:
+            reg = REGISTER.MCP_RXF3SIDH
+        elif ft == RXF.RXF4:
+            reg = REGISTER.MCP_RXF4SIDH
+        elif ft == RXF.RXF5:
+            reg = REGISTER.MCP_RXF5SIDH
+        else:
+            return ERROR.ERROR_FAIL
+
+        tbufdata = self.prepare_id(ext, ulData)
+
+        if not ext:
+            tbufdata[MCP_EID8] = data >> 8
+            tbufdata[MCP_EID0] = data & 0xff
+
+        self.set_registers(reg, tbufdata)
+        return ERROR.ERROR_OK
+
+    def set_filters(self, opcodes=None, hardware: bool = True, canid: int = 0) -> bool:
+        previous = self.opcode_filter
+        super().set_filters(opcodes, hardware, canid)
+
+        if self.opcode_filter == previous and (self.filter_mask != 0) == hardware:
+            return self.filter_mask != 0
+
+        if opcodes is None or not hardware:
+            mask, values = 0, (0,)
+        else:
+            mask, values = opcode_filter_cover(tuple(i for i in range(256) if self.opcode_filter[i]))
+
+        # only reprogram the device, which briefly stops reception, if the cover has changed
+        # before begin(), the new values are written when the device is initialised
+        if mask != self.filter_mask or values != self.filter_values:
+            self.filter_mask = mask
+            self.filter_values = values
+
+            if self.started and self.set_config_mode() == ERROR.ERROR_OK:
+                self.write_filters()
+                self.set_normal_mode()
+
+        return self.filter_mask != 0
+
+    def write_filters(self) -> int:
+        # RXM0 and RXF0-1 pass standard frames to RXB0 by opcode, and those that find RXB0 full roll over to RXB1
+        # RXM1 masks nothing and RXF2-5 match only extended frames, so RXB1 takes every extended frame
+        # the CAN ID bits are not masked, and an unused filter repeats the last value
+        # the data byte filter cannot tell frames with no data apart, so RTR and zero-length frames are
+        # only certain to pass with a mask of 0, see cbus.hardware_filter_allowed
+
+        result = self.set_filter_mask(MASK.MASK0, False, 0, self.filter_mask << 8)
+        if result != ERROR.ERROR_OK:
+            return result
+
+        for i, f in enumerate((RXF.RXF0, RXF.RXF1)):
+            value = self.filter_values[min(i, len(self.filter_values) - 1)]
+            result = self.set_filter(f, False, 0, value << 8)
+            if result != ERROR.ERROR_OK:
+                return result
+
+        result = self.set_filter_mask(MASK.MASK1, False, 0, 0)
+        if result != ERROR.ERROR_OK:
+            return result
+
+        for f in (RXF.RXF2, RXF.RXF3, RXF.RXF4, RXF.RXF5):
+            result = self.set_filter(f, True, 0)
+            if result != ERROR.ERROR_OK:
+                return result
+
+        return ERROR.ERROR_OK
 
-    # def process_txb_interrupt(self) -> None:
-    #     if self.tx_queue.available():
-    #         self.send_message_(self.tx_queue.dequeue())
-    #
     # def process_rxb_interrupt(self):
     #     err, msg = self.read_message_()
     #     if err == ERROR.ERROR_OK:
@@ -763,12 +949,44 @@ class mcp2515(canio.canio):
     #     else:
     #         return None
 
-    # def send_message(self, msg: canmessage.canmessage, txbn=None) -> int:
-    #     if self.txb_free[0] or self.txb_free[1] or self.txb_free[2]:
-    #         return self.send_message_(msg, txbn)
-    #     else:
-    #         self.tx_queue.enqueue(msg)
-    #         return ERROR.ERROR_OK
+    def send_message(self, msg: canmessage.canmessage) -> int:
+        # send now if a buffer is free, otherwise queue the frame for the TX complete interrupt handler
+        # the frame is encoded immediately, so the caller may reuse the message object
+        txp = self.tx_priority(msg)
+        image = self.encode_frame(msg)
+
+        if self.tx_queue.size == 0:
+            txbn = self.find_tx_buffer(txp)
+            if txbn >= 0:
+                self.load_tx_buffer(image, txbn, txp)
+                return ERROR.ERROR_OK
+
+        if self.tx_queue.put_nowait((image, txp, None)):
+            return ERROR.ERROR_OK
+
+        return ERROR.ERROR_ALLTXBUSY
+
+    async def queue_message(self, msg: canmessage.canmessage, wait_for_completion: bool = False) -> int:
+        # as send_message, but waits for space in the transmit queue rather than failing,
+        # and optionally until the frame has been transmitted, returning ERROR_FAILTX if it was aborted
+        txp = self.tx_priority(msg)
+        image = self.encode_frame(msg)
+        req = txrequest() if wait_for_completion else None
+
+        if self.tx_queue.size == 0 and (txbn := self.find_tx_buffer(txp)) >= 0:
+            self.load_tx_buffer(image, txbn, txp, req)
+        else:
+            while self.tx_queue.full():
+                self.tx_space_evt.clear()
+                await self.tx_space_evt.wait()
+
+            self.tx_queue.put_nowait((image, txp, req))
+
+        if req:
+            await req.evt.wait()
+            return req.result
+
+        return ERROR.ERROR_OK
 
     def send_message_(self, frame: canmessage.canmessage, txbn=None) -> int:
         if txbn is None:
@@ -777,52 +995,218 @@ class mcp2515(canio.canio):
         # if frame.dlc > CAN_MAX_DLEN:
         #     return ERROR.ERROR_FAILTX
 
-        txbuf = TXB[txbn]
+        if not self.txb_free[txbn]:
+            return ERROR.ERROR_ALLTXBUSY
+
+        self.load_tx_buffer(self.encode_frame(frame), txbn, self.tx_priority(frame))
+        return ERROR.ERROR_OK
+
+    def send_message__(self, frame: canmessage.canmessage) -> int:
+        # if frame.dlc > CAN_MAX_DLEN:
+        #     return ERROR.ERROR_FAILTX
+
+        txp = self.tx_priority(frame)
+        txbn = self.find_tx_buffer(txp)
+
+        if txbn < 0:
+            return ERROR.ERROR_ALLTXBUSY
+
+        self.load_tx_buffer(self.encode_frame(frame), txbn, txp)
+        return ERROR.ERROR_OK
+
+    @staticmethod
+    def tx_priority(frame: canmessage.canmessage) -> int:
+        # map the CBUS major priority in the header (0 = highest) to the TXBnCTRL TXP bits (3 = highest)
+        mjpri = (frame.canid >> 9) & 0x03
+        return 3 - mjpri if mjpri < 3 else 0
+
+    def encode_frame(self, frame: canmessage.canmessage) -> bytearray:
+        # the SIDH..DATA register image of a frame
         id_ = frame.canid & (CAN_EFF_MASK if frame.ext else CAN_SFF_MASK)
 
         if frame.rtr:
             id_ |= CAN_RTR_FLAG
 
-        data = self.prepare_id(frame.ext, id_)
-        mcp_dlc = (frame.dlc | RTR_MASK) if frame.rtr else frame.dlc
-
-        data.extend(bytearray(1 + frame.dlc))
-        data[MCP_DLC] = mcp_dlc
-        data[MCP_DATA: MCP_DATA + frame.dlc] = frame.data
+        image = bytearray(MCP_DATA + frame.dlc)
+        self.prepare_id_into(image, 0, frame.ext, id_)
+        image[MCP_DLC] = (frame.dlc | RTR_MASK) if frame.rtr else frame.dlc
+        image[MCP_DATA:] = frame.data[:frame.dlc]
+        return image
+
+    def find_tx_buffer(self, txp: int) -> int:
+        # the device sends the highest numbered of several pending buffers with equal priority first,
+        # so a frame must go in a free buffer numbered below every pending buffer with the same priority
+        # to keep frames in order, returns -1 if there is none
+        limit = N_TXBUFFERS
+
+        for n in range(N_TXBUFFERS):
+            if not self.txb_free[n] and self.txb_prio[n] == txp:
+                limit = n
+                break
 
-        self.set_registers(txbuf.SIDH, data)
+        for n in range(limit - 1, -1, -1):
+            if self.txb_free[n]:
+                return n
 
-        self.modify_register(
-            txbuf.CTRL, TXBnCTRL.TXB_TXREQ, TXBnCTRL.TXB_TXREQ, spifastend=True
-        )
+        return -1
 
+    def load_tx_buffer(self, image: bytearray, txbn: int, txp: int, req: txrequest = None) -> None:
+        txbuf = TXB[txbn]
+        buf = self.spi_txbuf
+        n = len(image)
+
+        self.txb_free[txbn] = False
+        self.txb_req[txbn] = req
+        self.txb_time[txbn] = time.ticks_ms()
+
+        if self.fast_io:
+            # LOAD TX BUFFER addresses TXBnSIDH implicitly, the priority needs a separate write if changed
+            if self.txb_prio[txbn] != txp:
+                self.set_register(txbuf.CTRL, txp)
+            buf[0] = txbuf.LOAD
+            buf[1:n + 1] = image
+            self.spi_write(n + 1)
+        else:
+            # write the priority in TXBnCTRL and the frame in the same transaction
+            buf[0] = INSTRUCTION.INSTRUCTION_WRITE
+            buf[1] = txbuf.CTRL
+            buf[2] = txp
+            buf[3:n + 3] = image
+            self.spi_write(n + 3)
+
+        self.txb_prio[txbn] = txp
+
+        # RTS replaces a TXREQ bit modify
+        buf[0] = txbuf.RTS
+        self.spi_write(1)
+
+    def process_tx_interrupts(self, intf: int) -> None:
+        # mark completed buffers free, then drain the transmit queue into them
+        flags = intf & CANINTF_TXIF_MASK
+        self.modify_register(REGISTER.MCP_CANINTF, flags, 0)
+
+        for n in range(N_TXBUFFERS):
+            if flags & TXB_CANINTF[n] and not self.txb_free[n]:
+                self.num_tx_complete += 1
+                self.complete_tx(n, ERROR.ERROR_OK)
+
+        self.drain_tx_queue()
+
+    def complete_tx(self, txbn: int, result: int) -> None:
+        # free a transmit buffer and tell any waiting sender the outcome
+        self.txb_free[txbn] = True
+        req = self.txb_req[txbn]
+
+        if req:
+            req.result = result
+            req.evt.set()
+            self.txb_req[txbn] = None
+
+    def abort_tx(self, txbn: int, reason: str = None) -> bool:
+        # stop the device retrying the frame in a buffer, returns False if the frame is on the bus
+        # or was sent meanwhile, which the TX complete interrupt then handles
+        txbuf = TXB[txbn]
+        self.modify_register(txbuf.CTRL, TXBnCTRL.TXB_TXREQ, 0)
         ctrl = self.read_register(txbuf.CTRL)
-        if ctrl & (TXBnCTRL.TXB_ABTF | TXBnCTRL.TXB_MLOA | TXBnCTRL.TXB_TXERR):
-            return ERROR.ERROR_FAILTX
 
-        return ERROR.ERROR_OK
+        if ctrl & TXBnCTRL.TXB_TXREQ or self.get_interrupts() & TXB_CANINTF[txbn]:
+            return False
 
-    def send_message__(self, frame: canmessage.canmessage) -> int:
-        # if frame.dlc > CAN_MAX_DLEN:
-        #     return ERROR.ERROR_FAILTX
+        if reason is None:
+            reason = 'lost arbitration' if ctrl & TXBnCTRL.TXB_MLOA else 'bus error' if ctrl & TXBnCTRL.TXB_TXERR else 'timed out'
 
-        tx_buffers = (TXBn.TXB0, TXBn.TXB1, TXBn.TXB2)
+        self.logger.log(f'mcp2515: transmit buffer {txbn} aborted, {reason}')
+        self.num_tx_failed += 1
+        self.complete_tx(txbn, ERROR.ERROR_FAILTX)
+        return True
 
-        for i in range(N_TXBUFFERS):
-            txbuf = TXB[tx_buffers[i]]
-            ctrlval = self.read_register(txbuf.CTRL)
-            if (ctrlval & TXBnCTRL.TXB_TXREQ) == 0:
-                return self.send_message_(frame, tx_buffers[i])
+    def check_tx_timeouts(self) -> None:
+        now = time.ticks_ms()
+        aborted = False
 
-        return ERROR.ERROR_ALLTXBUSY
+        for n in range(N_TXBUFFERS):
+            if not self.txb_free[n] and time.ticks_diff(now, self.txb_time[n]) > self.tx_timeout:
+                aborted = self.abort_tx(n) or aborted
+
+        if aborted:
+            self.drain_tx_queue()
+
+    async def tx_watchdog(self) -> None:
+        while True:
+            await asyncio.sleep_ms(self.tx_timeout >> 1)
+            self.check_tx_timeouts()
+
+    def process_error_interrupt(self) -> None:
+        # the device sends nothing while bus off, so pending frames are failed rather than left to time out
+        eflg = self.check_error_flags()
+        self.modify_register(REGISTER.MCP_CANINTF, CANINTF.CANINTF_ERRIF, 0)
+
+        if eflg & (EFLG.EFLG_RX0OVR | EFLG.EFLG_RX1OVR):
+            self.num_rx_overflows += 1
+            self.modify_register(REGISTER.MCP_EFLG, EFLG.EFLG_RX0OVR | EFLG.EFLG_RX1OVR, 0)
+
+        if eflg & EFLG.EFLG_TXBO:
+            self.logger.log('mcp2515: bus off')
+            aborted = False
+
+            for n in range(N_TXBUFFERS):
+                if not self.txb_free[n]:
+                    aborted = self.abort_tx(n, 'bus off') or aborted
+
+            if aborted:
+                self.drain_tx_queue()
+
+    def drain_tx_queue(self) -> None:
+        while self.tx_queue.size > 0:
+            image, txp, req = self.tx_queue.peek()
+            txbn = self.find_tx_buffer(txp)
+            if txbn < 0:
+                break
+            self.tx_queue.get_nowait()
+            self.load_tx_buffer(image, txbn, txp, req)
+            self.tx_space_evt.set()
 
     def read_message(self, rxbn: int = None) -> tuple:
         if rxbn is None:
             return self.read_message_()
 
+        if self.fast_io:
+            return self.read_rx_buffer(rxbn)
+
+        # read CTRL, SIDH..DLC and all data registers in a single transaction
         rxb = RXB[rxbn]
-        tbufdata = self.read_registers(rxb.SIDH, 1 + CAN_IDLEN)
+        self.read_registers(rxb.CTRL, RXB_BLOCK_LEN)
+        tbufdata = self.spi_rxmv[RXB_HEADER_OFFSET:]
+
+        if not self.accepts(tbufdata[MCP_DLC] & DLC_MASK, tbufdata[MCP_DATA], frame_canid(tbufdata)):
+            return ERROR.ERROR_FILTERED, None
+
+        rtr = self.spi_rxbuf[RXB_CTRL_OFFSET] & RXBnCTRL_RTR
+        return ERROR.ERROR_OK, self.decode_frame(tbufdata, rtr)
 
+    def read_rx_buffer(self, rxbn: int) -> tuple:
+        # READ RX BUFFER addresses RXBnSIDH implicitly and clears RXnIF when CS is released
+        buf = self.spi_txbuf
+        buf[0] = RXB[rxbn].READ
+
+        for i in range(1, RXB_FRAME_LEN + 1):
+            buf[i] = SPI_DUMMY_INT
+
+        self.spi_write_readinto(RXB_FRAME_LEN + 1)
+        tbufdata = self.spi_rxmv[1:]
+
+        if not self.accepts(tbufdata[MCP_DLC] & DLC_MASK, tbufdata[MCP_DATA], frame_canid(tbufdata)):
+            return ERROR.ERROR_FILTERED, None
+
+        # RXBnCTRL is not read, so take the RTR bit from SIDL or DLC
+        if tbufdata[MCP_SIDL] & TXB_EXIDE_MASK:
+            rtr = tbufdata[MCP_DLC] & RTR_MASK
+        else:
+            rtr = tbufdata[MCP_SIDL] & RXBnSIDL_SRR
+
+        return ERROR.ERROR_OK, self.decode_frame(tbufdata, rtr)
+
+    def decode_frame(self, tbufdata: memoryview, rtr: int) -> canmessage.canmessage:
         id_ = (tbufdata[MCP_SIDH] << 3) + (tbufdata[MCP_SIDL] >> 5)
 
         if (tbufdata[MCP_SIDL] & TXB_EXIDE_MASK) == TXB_EXIDE_MASK:
@@ -835,19 +1219,47 @@ class mcp2515(canio.canio):
         # if dlc_ > CAN_MAX_DLEN:
         #     return ERROR.ERROR_FAIL, None
 
-        ctrl = self.read_register(rxb.CTRL)
-        if ctrl & RXBnCTRL_RTR:
+        if rtr:
             id_ |= CAN_RTR_FLAG
 
-        frame = canmessage.canmessage(canid=id_, dlc=dlc_)
-        frame.data = bytearray(self.read_registers(rxb.DATA, dlc_))
+        frame = self.pool.get() if self.pool else canmessage.canmessage()
+
+        if id_ & CAN_EFF_FLAG:
+            frame.canid = id_
+            frame.make_header()
+        else:
+            # the whole header, as its priority bits are used to schedule the frame
+            frame.canid = id_ & 0x7ff
+
+        frame.dlc = dlc_
+        frame.rtr = rtr != 0
+        frame.ext = (id_ & CAN_EFF_FLAG) != 0
+        frame.data[:dlc_] = tbufdata[MCP_DATA: MCP_DATA + dlc_]
+        # a pooled frame keeps the polarity of the last event it held, which as_tuple() sets again for events
+        frame.polarity = canmessage.POLARITY_UNKNOWN
+        frame.invalidate()
 
-        return ERROR.ERROR_OK, frame
+        return frame
 
     def read_message_(self):
         rc = ERROR.ERROR_NOMSG, None
 
         stat = self.get_status()
+
+        if self.fast_io:
+            # the RXnIF flag is cleared by the read itself, and the status already read says
+            # whether RXB1 also holds a frame
+            if stat & STAT.STAT_RX0IF and self.mcp2515_rx_index == 0:
+                rc = self.read_rx_buffer(RXBn.RXB0)
+                if stat & STAT.STAT_RX1IF:
+                    self.mcp2515_rx_index = 1
+            elif stat & STAT.STAT_RX1IF:
+                rc = self.read_rx_buffer(RXBn.RXB1)
+                self.mcp2515_rx_index = 0
+            elif stat & STAT.STAT_RX0IF:
+                rc = self.read_rx_buffer(RXBn.RXB0)
+            return rc
+
         if stat & STAT.STAT_RX0IF and self.mcp2515_rx_index == 0:
             rc = self.read_message(RXBn.RXB0)
             if self.get_status() & STAT.STAT_RX1IF:
@@ -857,6 +1269,9 @@ class mcp2515(canio.canio):
             rc = self.read_message(RXBn.RXB1)
             self.mcp2515_rx_index = 0
             self.modify_register(REGISTER.MCP_CANINTF, RXB[RXBn.RXB1].CANINTFRXnIF, 0)
+        elif stat & STAT.STAT_RX0IF:
+            rc = self.read_message(RXBn.RXB0)
+            self.modify_register(REGISTER.MCP_CANINTF, RXB[RXBn.RXB0].CANINTFRXnIF, 0)
 
         return rc
 
@@ -866,14 +1281,20 @@ class mcp2515(canio.canio):
 
         while self.check_receive():
             # self.logger.log('mcp2515 has message')
-            # us = time.ticks_us()
+            # timestamp frames as they are read, before they wait in the queue
+            us = time.ticks_us()
             r, msg = self.read_message(rxbn)
             if r == ERROR.ERROR_OK:
+                msg.timestamp = us
                 # self.logger.log('mcp2515: enqueuing new message')
-                await self.rx_queue.enqueue(msg)
-                msgs += 1
+                if await self.rx_queue.enqueue(msg):
+                    msgs += 1
+                else:
+                    msg.release()
                 # self.logger.log(f'message processing took {time.ticks_diff(time.ticks_us(), us)} us')
                 # self.logger.log('message queued')
+            elif r == ERROR.ERROR_FILTERED:
+                pass
             else:
                 self.logger.log(f'mcp2515: no message to read, err = {r}')
 